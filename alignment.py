@@ -0,0 +1,146 @@
+import numpy as np
+
+import cartoutils
+
+# common timeline of the contact force and the ECG of the points of a study
+# the contact force rows carry the relative Time (ms) and the absolute Timestamp (ms) of every sample,
+# the ECG export has no time column: its samples are placed at ECG_START + i * 1000 / ECG_RATE ms of the CF Time
+# (the 2500 ms of ECG are the 50 CF samples with Time >= 0, see cartoutils.CF_WINDOW)
+ALIGN_COLS = [1, 2, 3, 4, 5]  # cf_cols of the study readers with the time: Time, Timestamp, Force, Axial, Lateral
+TIME_ROW = 0                  # rows of cf_data read with cf_cols=ALIGN_COLS
+TIMESTAMP_ROW = 1
+ECG_START = 0                 # CF Time of the first ECG sample, ms
+ECG_RATE = 1000               # ECG samples per second
+REDUCE = {'mean': np.add, 'min': np.minimum, 'max': np.maximum, 'ptp': None}
+
+
+def get_timeline(cf_data, ecg_samples=cartoutils.ECG_SAMPLES, ecg_start=ECG_START, ecg_rate=ECG_RATE):
+    """
+    Timestamps of the CF and ECG samples of every point on the clock of the Timestamp column
+    the Timestamp of Time 0 is the median of Timestamp - Time over the samples of the point
+    (read cf_data with dtype='float64', float32 can not hold the Timestamps exactly)
+    :param cf_data: contact data with the shape = (#of points, len(cols), samples) read with cf_cols=ALIGN_COLS
+    :param ecg_samples: number of ECG samples of a point
+    :param ecg_start: CF Time of the first ECG sample, ms
+    :param ecg_rate: ECG samples per second
+    :return: two Numpy arrays 1) CF times with the shape = (#of points, CF samples), NaN for missing samples
+                              2) ECG times with the shape = (#of points, ecg_samples)
+    """
+    cf_data = np.asarray(cf_data, dtype=float)
+    zero = np.nanmedian(cf_data[:, TIMESTAMP_ROW] - cf_data[:, TIME_ROW], axis=1)
+    ecg_times = zero[:, np.newaxis] + ecg_start + np.arange(ecg_samples) * 1000. / ecg_rate
+    return cf_data[:, TIMESTAMP_ROW], ecg_times
+
+
+def _shift_rows(times, new_times):
+    # shift of every row, so the rows of times and new_times are in separate ranges of one ascending axis
+    # and the samples of all points are searched (or interpolated) by one call
+    with np.errstate(invalid='ignore'):
+        low = np.fmin(np.fmin.reduce(times, axis=1), np.fmin.reduce(new_times, axis=1))
+        high = np.fmax(np.fmax.reduce(times, axis=1), np.fmax.reduce(new_times, axis=1)) - low
+    low[np.isnan(low)] = 0
+    high = np.nanmax(high, initial=0) + 1
+    return (np.arange(len(times)) * 2 * high - low)[:, np.newaxis]
+
+
+def _count_before(times, new_times, side='right'):
+    # np.searchsorted of every row of new_times in the same row of times (ascending, NaN for missing samples),
+    # NaN new times give 0
+    shift = _shift_rows(times, new_times)
+    valid = ~np.isnan(times)
+    before = (np.cumsum(valid.sum(axis=1)) - valid.sum(axis=1))[:, np.newaxis]  # samples of the previous rows
+    counts = np.searchsorted((times + shift)[valid], new_times + shift, side) - before
+    counts[np.isnan(new_times)] = 0
+    return counts
+
+
+def interpolate(values, times, new_times):
+    """
+    linear interpolation of the samples of every point at new times, e.g. the contact force at the ECG samples:
+    interpolate(cf_data[:, 2:], *get_timeline(cf_data))
+    the rows of all points are shifted to one time axis and interpolated by one np.interp call per channel
+    :param values: Numpy array with the shape = (#of points, channels, samples)
+    :param times: times of the samples with the shape = (#of points, samples), ascending,
+            NaN for missing samples at the end
+    :param new_times: times with the shape = (#of points, new samples)
+    :return: Numpy array with the shape = (#of points, channels, new samples), NaN outside the samples of the point
+    """
+    values = np.asarray(values, dtype=float)
+    times = np.asarray(times, dtype=float)
+    new_times = np.asarray(new_times, dtype=float)
+    shift = _shift_rows(times, new_times)
+    times = times + shift
+    valid = ~np.isnan(times)
+    # the samples of every point are enclosed by NaN samples just before the first and after the last sample,
+    # so the new times between the samples of two points are NaN (the last sample is repeated before the NaN,
+    # np.interp gives NaN at the last sample itself otherwise)
+    first = np.min(times, axis=1, initial=np.inf, where=valid, keepdims=True)
+    last = np.max(times, axis=1, initial=-np.inf, where=valid, keepdims=True)
+    after_last = np.nextafter(last, np.inf)
+    xp = np.concatenate([np.nextafter(first, -np.inf), times, after_last, np.nextafter(after_last, np.inf)], axis=1)
+    filled = np.isfinite(xp)
+    last_index = np.maximum(np.sum(valid, axis=1, keepdims=True) - 1, 0)
+    x = new_times + shift
+    result = np.empty((len(values), values.shape[1]) + new_times.shape[1:])
+    nan = np.full((len(values), 1), np.nan)
+    for channel in range(values.shape[1]):
+        fp = np.concatenate([nan, values[:, channel], np.take_along_axis(values[:, channel], last_index, axis=1),
+                             nan], axis=1)
+        result[:, channel] = np.interp(x, xp[filled], fp[filled], left=np.nan, right=np.nan)
+    return result
+
+
+def window_reduce(values, times, starts, ends, reduce='mean'):
+    """
+    reduces the samples of every point in time windows [start, end), e.g. beats or the intervals of the CF samples
+    :param values: Numpy array with the shape = (#of points, channels, samples)
+    :param times: times of the samples with the shape = (#of points, samples), ascending,
+            NaN for missing samples at the end
+    :param starts: starts of the windows with the shape = (#of points, windows)
+    :param ends: ends of the windows with the shape = (#of points, windows)
+    :param reduce: 'mean', 'min', 'max' or 'ptp' (max - min)
+    :return: Numpy array with the shape = (#of points, channels, windows), NaN for windows without samples
+    """
+    if reduce not in REDUCE:
+        raise ValueError('Unknown reduce {}, use {}'.format(reduce, ', '.join(REDUCE)))
+    if reduce == 'ptp':
+        return (window_reduce(values, times, starts, ends, 'max')
+                - window_reduce(values, times, starts, ends, 'min'))
+    values = np.asarray(values, dtype=float)
+    times = np.asarray(times, dtype=float)
+    points, channels, samples = values.shape
+    first = _count_before(times, np.asarray(starts, dtype=float), 'left')
+    last = _count_before(times, np.asarray(ends, dtype=float), 'left')
+    empty = last <= first
+
+    # the windows of all points and channels are reduced by one reduceat call on the flattened values:
+    # pairs (first, last) of indexes, the results of the odd indexes (between the windows) are dropped
+    rows = (np.arange(points * channels) * samples).reshape(points, channels, 1)
+    indices = np.stack([rows + first[:, np.newaxis], rows + np.maximum(last, first)[:, np.newaxis]], axis=-1)
+    flat = np.append(values.ravel(), 0)  # index of the end of the last window
+    result = REDUCE[reduce].reduceat(flat, indices.ravel())[::2].reshape(points, channels, -1)
+    if reduce == 'mean':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result /= (last - first)[:, np.newaxis]
+    result[np.broadcast_to(empty[:, np.newaxis], result.shape)] = np.nan
+    return result
+
+
+def ecg_to_cf(values, ecg_times, cf_times, reduce='mean'):
+    """
+    ECG samples (or features of the ECG samples) on the CF samples: every CF sample gets the ECG samples
+    between the midpoints to the previous and the next CF sample
+    :param values: Numpy array with the shape = (#of points, channels, ECG samples), e.g. ecg data
+    :param ecg_times: ECG times from get_timeline()
+    :param cf_times: CF times from get_timeline()
+    :param reduce: 'mean', 'min', 'max' or 'ptp', see window_reduce()
+    :return: Numpy array with the shape = (#of points, channels, CF samples)
+    """
+    cf_times = np.asarray(cf_times, dtype=float)
+    middles = (cf_times[:, 1:] + cf_times[:, :-1]) / 2
+    # the first and the last CF sample get half of the interval to the neighbour on the other side
+    starts = np.concatenate([2 * cf_times[:, :1] - middles[:, :1], middles], axis=1)
+    ends = np.concatenate([middles, 2 * cf_times[:, -1:] - middles[:, -1:]], axis=1)
+    # the last sample of a point with missing samples at the end
+    ends = np.where(np.isnan(ends) & ~np.isnan(cf_times), 2 * cf_times - starts, ends)
+    return window_reduce(values, ecg_times, starts, ends, reduce)
@@ -0,0 +1,744 @@
+"""
+Benchmarks for the readers in cartoutils.py and simple.py, the template matching in matching.py
+and the ECG printouts of ecg_writer.py
+every benchmark compares the current implementation against the previous (reference) one,
+checks that both return identical results and prints the timings (bench_memory prints the memory use)
+
+usage: python benchmark.py [zip archive with a Carto study]
+without arguments a synthetic study is generated in a temporary directory,
+the EP-system export is always synthetic (1M samples x 32 channels)
+"""
+import io
+import itertools
+import os
+import re
+import sys
+import tempfile
+import timeit
+import tracemalloc
+import warnings
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
+import pandas as pd
+from scipy import signal
+from scipy.stats import pearsonr
+
+import alignment
+import binary_cache
+import cartoutils
+import ecg_writer
+import ecg_writer_small
+import egm_features
+import egm_index
+import filters
+import matching
+import simple
+
+ALL_CHANNELS = ['I', 'II', 'III', 'aVL', 'aVR', 'aVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6',
+                'M1', 'M2', 'M3', 'M4', 'M1-M2', 'M3-M4', 'CS1', 'CS2', 'CS3', 'CS4', 'CS5', 'CS6']
+
+
+def make_ecg_export(rng, samples=cartoutils.ECG_SAMPLES):
+    """
+    generates the content of a synthetic _ECG_Export.txt file
+    :param rng: numpy random generator
+    :param samples: number of samples per channel
+    :return: file content as str
+    """
+    header = ' '.join('{}({})'.format(name, 100 + i) for i, name in enumerate(ALL_CHANNELS))
+    data = rng.integers(-3000, 3000, size=(samples, len(ALL_CHANNELS)))
+    lines = ['ECG_Export_4.0',
+             'Raw ECG to MV (gain) = 0.003',
+             'Unipolar Mapping Channel=M1 Bipolar Mapping Channel=M1-M2 Reference Channel=V1',
+             header]
+    lines += [' '.join(str(value) for value in row) for row in data]
+    return '\n'.join(lines) + '\n'
+
+
+def make_contact_force(rng, samples=cartoutils.CF_SAMPLES):
+    """
+    generates the content of a synthetic _ContactForce.txt file (50 Hz, 200 samples)
+    :param rng: numpy random generator
+    :param samples: number of samples
+    :return: file content as str
+    """
+    lines = ['ContactForce.txt_2.0',
+             'Rate=50\tNumber ={}\tDate:05/05/21\tPoint Time:14:27:09\tSystem Time:14:27:09\t'.format(samples),
+             'Mode=0',
+             'IntervalGraph=100',
+             '3381123\t0.321241\t0\t0\t0\t0\t0\t',
+             'IntervalNonGraph=1000',
+             '3381573\t0.734095\t0\t0\t0\t0\t0\t',
+             'Index\tTime\tTimestamp\tForceValue\tAxialAngle\tLateralAngle\tMetalSeverity\tInAccurateSeverity'
+             '\tNeedZeroing\t']
+    for i in range(samples):
+        time = -7482 + 50 * i
+        lines.append('{}\t{}\t{}\t{:.6g}\t0\t0\t0\t0\t0\t'.format(i + 1, time, 3371623 + 50 * i,
+                                                               rng.normal(10, 3)))
+    return '\n'.join(lines) + '\n'
+
+
+def make_study_zip(zip_filename, points=50, seed=0, maps=('1-Map', '2-LA')):
+    """
+    writes a synthetic Carto study export with ContactForce/ECG_Export pairs
+    :param zip_filename: name of the zip archive to create
+    :param points: number of points
+    :param seed: seed of the random generator
+    :param maps: names of the maps the points are distributed over
+    :return: zip_filename
+    """
+    rng = np.random.default_rng(seed)
+    with ZipFile(zip_filename, 'w', ZIP_DEFLATED) as zip_file:
+        for point in range(1, points + 1):
+            current_map = maps[point % len(maps)]
+            zip_file.writestr('{}_P{}_ContactForce.txt'.format(current_map, point), make_contact_force(rng))
+            zip_file.writestr('{}_P{}_ECG_Export.txt'.format(current_map, point), make_ecg_export(rng))
+    return zip_filename
+
+
+def make_ep_export(filename, samples=1000000, channels=32, seed=0):
+    """
+    writes a synthetic EP-system export with [Header] and comma separated [Data] sections
+    :param filename: name of the file to create
+    :param samples: number of samples per channel
+    :param channels: number of exported channels
+    :param seed: seed of the random generator
+    :return: filename
+    """
+    rng = np.random.default_rng(seed)
+    with open(filename, 'w') as file:
+        file.write('[Header]\nFile Type: 1\nVersion: 1\nChannels exported: {}\nSamples per channel: {}\n'
+                   'Start time: 10:00:00\nEnd time: 10:16:40\nData Format: ASCII\nSample Rate: 1000Hz\n'
+                   .format(channels, samples))
+        for channel in range(1, channels + 1):
+            file.write('Channel #: {}\nLabel: ch{}\nRange: 5mv\nLow: 0.05Hz\nHigh: 100Hz\nSample rate: 1000Hz\n'
+                       'Color: 0,0,0\nScale: 1\n'.format(channel, channel))
+        file.write('[Data]\n')
+        for block_start in range(0, samples, 100000):
+            block = rng.integers(-2000, 2000, size=(min(100000, samples - block_start), channels))
+            file.write(''.join(','.join(map(str, row)) + '\n' for row in block.tolist()))
+    return filename
+
+
+def reference_get_channels(filename, channel_range=None, start=0, end=None):
+    """
+    previous implementation of simple.get_channels: readlines() + np.fromstring/np.take/np.append per sample
+    (the header is parsed by simple.read_header, unchanged)
+    """
+    if isinstance(channel_range, int):
+        channel_range = (channel_range,)
+    with open(filename, 'r') as file:
+        header = simple.read_header(file, filename, channel_range)
+        lines = file.readlines()
+    if not end:
+        end = header["samples_per_channel"]
+    header["channels"] = list(channel_range) if channel_range else list(range(1, header["channels_exported"] + 1))
+    header["sample_count"] = len(lines[start:end])
+    channel_count = len(channel_range) if channel_range else header["channels_exported"]
+    channels = np.empty((0, channel_count), int)
+    for line in lines[start:end]:
+        newline = np.take(np.fromstring(line, dtype=int, sep=','),
+                          channel_range if channel_range else range(header["channels_exported"]))
+        channels = np.append(channels, [newline], axis=0)
+    return np.transpose(channels), header
+
+
+def reference_ecg_data_from_zipped_txt(zip_file, ecg_filename):
+    """
+    previous per-line implementation of cartoutils.get_ecg_data_from_zipped_txt (np.append per sample)
+    """
+    lines = zip_file.read(ecg_filename).splitlines()
+    read_data = False
+    ecg_array = np.empty((0, len(cartoutils.Mapping_Channels)), int)
+    channel_indexes = []
+    for i, line in enumerate(lines):
+        if read_data:
+            newline = np.fromstring(line, dtype=int, sep=' ')
+            channel_data = np.take(newline, channel_indexes, axis=0)
+            ecg_array = np.append(ecg_array, [channel_data], axis=0)
+        if i == 3:
+            read_data = True
+            channel_names = line.decode('utf8').split()
+            for channel_number, channel_name in enumerate(channel_names):
+                channel_names[channel_number] = re.search(r'(.*)\(.', channel_name).group(1)
+            for mapping_channel_name in cartoutils.Mapping_Channels:
+                channel_indexes.append(channel_names.index(mapping_channel_name))
+    return ecg_array.T
+
+
+def reference_ecg_leads_from_zip(zip_file, ecg_filename, leads):
+    """
+    previous per-line implementation of ecg_writer.get_ecg_data / ecg_writer_small.get_ecg_data_from_zip
+    (dict lookup per lead and np.append per sample)
+    """
+    lines = zip_file.read(ecg_filename).splitlines()
+    ecg_array = np.empty((0, len(leads)), int)
+    indices = []
+    for i, line in enumerate(lines):
+        if i > 3:
+            newline = np.fromstring(line.decode('utf8'), dtype=int, sep=' ')
+            ecg_array = np.append(ecg_array, [[newline[index] for index in indices]], axis=0)
+        if i == 3:
+            channel_names = [re.search(r'(.*)\(.', c).group(1) for c in line.decode('utf8').split()]
+            indices = [channel_names.index(lead) for lead in leads]
+    return ecg_array.T
+
+
+def reference_study_data_from_zip(zip_filename, cf_start=150, cf_cols=[3, 4, 5]):
+    """
+    previous implementation of cartoutils.get_study_data_from_zip (np.append per point)
+    """
+    cf_files, ecg_files = cartoutils.get_files_from_zip(zip_filename)
+    cf_array = np.empty((0, len(cf_cols), cartoutils.CF_SAMPLES - cf_start), float)
+    ecg_array = np.empty((0, len(cartoutils.Mapping_Channels), cartoutils.ECG_SAMPLES), float)
+    with ZipFile(zip_filename, 'r') as zip_file:
+        for cf_file, ecg_file in zip(cf_files, ecg_files):
+            new_cf_point = cartoutils.get_contact_data_from_zipped_txt(zip_file, cf_filename=cf_file, start=cf_start,
+                                                                       cols=cf_cols)
+            cf_array = np.append(cf_array, [new_cf_point], axis=0)
+            new_ecg_point = cartoutils.get_ecg_data_from_zipped_txt(zip_file, ecg_filename=ecg_file)
+            ecg_array = np.append(ecg_array, [new_ecg_point], axis=0)
+    return cf_array, ecg_array
+
+
+def make_egm(rng, samples=cartoutils.ECG_SAMPLES, cycle=600, flat=0):
+    """
+    generates a synthetic integer EGM: a noisy deflection every cycle samples
+    :param rng: numpy random generator
+    :param flat: length of a flat (constant) segment in the middle
+    :return: Numpy array with shape = (samples,)
+    """
+    t = np.arange(samples)
+    egm = 800 * np.exp(-((t % cycle) - 150) ** 2 / 200.) * np.sin((t % cycle) / 4.)
+    egm = np.round(egm + rng.normal(0, 20, samples))
+    egm[samples // 2:samples // 2 + flat] = egm[samples // 2]
+    return egm
+
+
+def reference_correlate_signals(template, signal):
+    """
+    previous implementation of matching.normalized_cross_correlation (correlate_signals in Signal_matching.ipynb)
+    """
+    rr = []
+    for i in range(len(signal)-len(template)+1):
+        r, _ = pearsonr(template, signal[i:i+(len(template))])
+        rr.append(r)
+    best_i = np.argmax(rr)
+    padded_template = np.append(np.zeros(best_i), template)
+    return np.nanmax(rr), padded_template, best_i
+
+
+def reference_match(template, signal):
+    """
+    previous implementation of matching.match (match in Signal_matching.ipynb)
+    """
+    mm = []
+    for i in range(len(signal) - len(template)+1):
+        m = matching.matching(np.asarray(template), np.asarray(signal[i:i+(len(template))]))
+        mm.append(m)
+    best_i = np.argmax(mm)
+    padded_template = np.append(np.zeros(best_i), template)
+    return np.nanmax(mm), padded_template, best_i
+
+
+def bench(name, current, reference, repeat=3, compare=None):
+    """
+    times the current and reference callables, checks that the results are equal
+    :param compare: function (current result, reference result) -> bool instead of the exact comparison
+    :return: tuple of best times (current, reference) in seconds
+    """
+    current_result, reference_result = current(), reference()
+    if compare is not None:
+        equal = compare(current_result, reference_result)
+    elif isinstance(current_result, tuple):
+        equal = all(c == r if isinstance(c, dict) else np.array_equal(c, r)
+                    for c, r in zip(current_result, reference_result))
+    else:
+        equal = np.array_equal(current_result, reference_result)
+    if not equal:
+        raise AssertionError('{}: results differ from the reference implementation'.format(name))
+    current_time = min(timeit.repeat(current, number=1, repeat=repeat))
+    reference_time = min(timeit.repeat(reference, number=1, repeat=repeat))
+    print('{:<40} current {:9.4f} s   reference {:9.4f} s   speedup x{:.1f}'
+          .format(name, current_time, reference_time, reference_time / current_time))
+    return current_time, reference_time
+
+
+def bench_ecg_parser(zip_filename, points=20):
+    with ZipFile(zip_filename, 'r') as zip_file:
+        ecg_files = [f for f in zip_file.namelist() if f.endswith('_ECG_Export.txt')][:points]
+        bench('get_ecg_data_from_zipped_txt x{}'.format(len(ecg_files)),
+              lambda: tuple(cartoutils.get_ecg_data_from_zipped_txt(zip_file, f) for f in ecg_files),
+              lambda: tuple(reference_ecg_data_from_zipped_txt(zip_file, f) for f in ecg_files))
+        bench('ecg_writer_small.get_ecg_data_from_zip x{}'.format(len(ecg_files)),
+              lambda: tuple(ecg_writer_small.get_ecg_data_from_zip(zip_file, f, ecg_writer_small.LEADS)[0]
+                            for f in ecg_files),
+              lambda: tuple(reference_ecg_leads_from_zip(zip_file, f, ecg_writer_small.LEADS) for f in ecg_files))
+
+
+def bench_study_loading(zip_filename):
+    # the time is spent parsing the points, the preallocated buffers make the peak memory close to the arrays
+    # (np.append copies the whole array for every point)
+    bench('get_study_data_from_zip',
+          lambda: cartoutils.get_study_data_from_zip(zip_filename, progress=False),
+          lambda: reference_study_data_from_zip(zip_filename))
+    for name, load in (('current', lambda: cartoutils.get_study_data_from_zip(zip_filename, progress=False)),
+                       ('reference', lambda: reference_study_data_from_zip(zip_filename))):
+        tracemalloc.start()
+        cf_data, ecg_data = load()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('{:<40} arrays {:8.1f} MB   peak {:8.1f} MB'.format(
+            'get_study_data_from_zip ' + name, (cf_data.nbytes + ecg_data.nbytes) / 1e6, peak / 1e6))
+
+
+def bench_get_channels(ep_filename, reference_samples=20000):
+    # the reference is O(n^2), so it is compared on a window only, the current version also on the whole file
+    for channel_range, start in ((None, 1000), ((1, 2, 6, 7, 8, 9, 18, 19), 500000)):
+        bench('get_channels {} samples, {} channels'.format(reference_samples,
+                                                            len(channel_range) if channel_range else 'all'),
+              lambda: simple.get_channels(ep_filename, channel_range, start=start, end=start + reference_samples),
+              lambda: reference_get_channels(ep_filename, channel_range, start=start,
+                                             end=start + reference_samples), repeat=1)
+    current_time = min(timeit.repeat(lambda: simple.get_channels(ep_filename), number=1, repeat=1))
+    print('{:<40} current {:9.4f} s'.format('get_channels whole file', current_time))
+    # window near the end of the file: seek with the sample index vs skipping lines
+    simple.get_sample_index(ep_filename)
+    bench('get_channels use_index=True 900 samples',
+          lambda: simple.get_channels(ep_filename, (1, 2), start=950000, end=950900, use_index=True),
+          lambda: simple.get_channels(ep_filename, (1, 2), start=950000, end=950900))
+
+
+def _same_correlation(current, reference):
+    # r is compared with a tolerance (FFT rounding), the lag and the padded template exactly
+    return (np.isclose(current[0], reference[0], rtol=1e-9, atol=1e-12) and current[2] == reference[2]
+            and np.array_equal(current[1], reference[1]))
+
+
+def bench_template_matching(seed=0):
+    rng = np.random.default_rng(seed)
+    signal = make_egm(rng)
+    template = signal[1355:1480]
+    templates = {'template from the signal': template,
+                 'noisy template': template + rng.normal(0, 50, len(template)),
+                 'shifted template': signal[1240:1365]}
+    for name, current_template in templates.items():
+        bench('normalized_cross_correlation {}'.format(name),
+              lambda: matching.normalized_cross_correlation(current_template, signal),
+              lambda: reference_correlate_signals(current_template, signal), compare=_same_correlation)
+    # the match scores of integer signals are identical at every lag, also when computed in small chunks
+    for chunk_size in (matching.CHUNK_LAGS, 100):
+        bench('match chunk_size={}'.format(chunk_size),
+              lambda: matching.match(template, signal, chunk_size=chunk_size),
+              lambda: reference_match(template, signal))
+    mm = [matching.matching(template, signal[i:i + len(template)]) for i in range(len(signal) - len(template) + 1)]
+    if not np.array_equal(matching.sliding_match(template, signal, chunk_size=100), mm):
+        raise AssertionError('sliding_match: scores differ from matching()')
+
+    # r at every lag, windows without variance are NaN in both versions
+    # (the lag of the best correlation differs then, the reference returns the first NaN window)
+    signal = make_egm(rng, flat=200)
+    rr = [pearsonr(template, signal[i:i + len(template)])[0] for i in range(len(signal) - len(template) + 1)]
+    if not np.allclose(matching.sliding_correlation(template, signal), rr, rtol=1e-9, atol=1e-12, equal_nan=True):
+        raise AssertionError('sliding_correlation: r differs from scipy.stats.pearsonr')
+
+
+def reference_search(template, ecg_data, k=10):
+    """
+    one similarity() call per point and channel, the loop which matching.search replaces
+    """
+    results = []
+    for point in range(len(ecg_data)):
+        for channel in range(ecg_data.shape[1]):
+            score, _, lag = matching.similarity(template, ecg_data[point, channel])
+            if not np.isnan(score):
+                results.append((point, channel, int(lag), float(score)))
+    return sorted(results, key=lambda result: -result[3])[:k]
+
+
+def _same_search(current, reference):
+    return ([result[:3] for result in current] == [result[:3] for result in reference]
+            and np.allclose([result[3] for result in current], [result[3] for result in reference]))
+
+
+def bench_search(points=500, seed=0):
+    rng = np.random.default_rng(seed)
+    ecg_data = np.stack([np.stack([make_egm(rng, cycle=500 + 7 * point + channel)
+                                   for channel in range(len(cartoutils.Mapping_Channels))])
+                         for point in range(points)])
+    template = ecg_data[points // 3, 4, 1000:1125] + rng.normal(0, 30, 125)
+    for workers in (1, 2):
+        bench('search {} points workers={}'.format(points, workers),
+              lambda: matching.search(template, ecg_data, workers=workers),
+              lambda: reference_search(template, ecg_data), repeat=1, compare=_same_search)
+
+
+def bench_search_pool(points=matching.POOL_MIN_POINTS, workers=2, seed=0):
+    # the process pool against the serial search at the size where the pool is used,
+    # the speedup depends on the number of CPUs
+    rng = np.random.default_rng(seed)
+    egms = np.stack([np.stack([make_egm(rng, cycle=500 + 7 * point + channel)
+                               for channel in range(len(cartoutils.Mapping_Channels))])
+                     for point in range(100)])
+    ecg_data = np.concatenate([egms + rng.normal(0, 5, egms.shape) for _ in range(points // len(egms))])
+    template = ecg_data[points // 3, 4, 1000:1125] + rng.normal(0, 30, 125)
+    bench('search {} points workers={} ({} CPUs)'.format(len(ecg_data), workers, os.cpu_count()),
+          lambda: matching.search(template, ecg_data, workers=workers),
+          lambda: matching.search(template, ecg_data, workers=1), repeat=1)
+
+
+def bench_egm_index(points=2000, queries=20, seed=0):
+    # recall of the index against the exhaustive matching.search and the time of one query
+    rng = np.random.default_rng(seed)
+    ecg_data = np.stack([np.stack([make_egm(rng, cycle=300 + (point % 50) * 10 + channel * 3)
+                                   for channel in range(len(cartoutils.Mapping_Channels))])
+                         for point in range(points)]).astype(np.int16)
+    with tempfile.TemporaryDirectory() as index_dir:
+        # the last points are added incrementally as a new study would be
+        egm_index.build_index(index_dir, ecg_data[:points * 3 // 4])
+        egm_index.add_to_index(index_dir, ecg_data)
+        index = egm_index.load_index(index_dir)
+        found, query_time, search_time = 0, 0, 0
+        for point in rng.choice(points, queries, replace=False):
+            egm = ecg_data[point, rng.integers(ecg_data.shape[1])] + rng.normal(0, 30, ecg_data.shape[2])
+            start_time = timeit.default_timer()
+            results = egm_index.query(index, ecg_data, egm)
+            query_time += timeit.default_timer() - start_time
+            start_time = timeit.default_timer()
+            reference = matching.search(egm, ecg_data)
+            search_time += timeit.default_timer() - start_time
+            found += len({result[:2] for result in results} & {result[:2] for result in reference})
+    print('{:<40} current {:9.4f} s   reference {:9.4f} s   speedup x{:.1f}   recall@10 {:.2f}'.format(
+        'egm_index.query {} points'.format(points), query_time / queries, search_time / queries,
+        search_time / query_time, found / (10. * queries)))
+
+
+def reference_egm_features(ecg_data):
+    # per point and channel features with the definitions of egm_features.compute_features
+    features = np.empty(len(ecg_data), egm_features.FEATURE_DTYPE)
+    for point in range(len(ecg_data)):
+        for channel, name in enumerate(cartoutils.Mapping_Channels):
+            x = np.asarray(ecg_data[point, channel], dtype=np.float32)
+            x = x - np.median(x)
+            amplitude = np.abs(x)
+            peak = amplitude.max()
+            row = features[point]
+            row['ptp'][channel] = x.max() - x.min()
+            if peak == 0:
+                row['lat'][channel], row['duration'][channel], row['deflections'][channel] = np.nan, 0, 0
+                continue
+            row['lat'][channel] = np.argmax(amplitude) if '-' in name else np.argmin(np.diff(x))
+            active = np.nonzero(amplitude > egm_features.DURATION_FRACTION * peak)[0]
+            row['duration'][channel] = active[-1] - active[0]
+            deflections, last_sign = 0, 0
+            for i, sign in enumerate(np.sign(np.diff(x))):
+                if sign != 0:
+                    if last_sign != 0 and sign != last_sign and amplitude[i] > egm_features.DEFLECTION_FRACTION * peak:
+                        deflections += 1
+                    last_sign = sign
+            row['deflections'][channel] = deflections
+    return features
+
+
+def _same_features(current, reference):
+    return all(np.array_equal(current[name], reference[name], equal_nan=True) for name in current.dtype.names)
+
+
+def bench_egm_features(points=1000, reference_points=100, seed=0):
+    rng = np.random.default_rng(seed)
+    ecg_data = np.stack([np.stack([make_egm(rng, cycle=300 + (point % 50) * 10 + channel * 3)
+                                   for channel in range(len(cartoutils.Mapping_Channels))])
+                         for point in range(points)]).astype(np.int16)
+    bench('egm_features.compute_features x{}'.format(reference_points),
+          lambda: egm_features.compute_features(ecg_data[:reference_points], progress=False),
+          lambda: reference_egm_features(ecg_data[:reference_points]), repeat=1, compare=_same_features)
+    # float32 input (e.g. filter_signals output) and a read-only memmap are left unchanged
+    float_data = ecg_data[:reference_points].astype(np.float32)
+    expected = float_data.copy()
+    with tempfile.TemporaryDirectory() as data_dir:
+        np.save(os.path.join(data_dir, 'ecg_data.npy'), float_data)
+        mapped = np.load(os.path.join(data_dir, 'ecg_data.npy'), mmap_mode='r')
+        for data in (float_data, mapped):
+            if not _same_features(egm_features.compute_features(data, progress=False),
+                                  reference_egm_features(expected)) or not np.array_equal(data, expected):
+                raise AssertionError('egm_features.compute_features changed its float32 input')
+        del mapped
+    with tempfile.TemporaryDirectory() as data_dir:
+        # the last points are added incrementally as a new study would be, the following calls load the table
+        egm_features.get_features(data_dir, ecg_data[:points * 3 // 4])
+        start_time = timeit.default_timer()
+        computed = np.array(egm_features.get_features(data_dir, ecg_data))
+        append_time = timeit.default_timer() - start_time
+        loaded = min(timeit.repeat(lambda: egm_features.get_features(data_dir, ecg_data), number=1, repeat=3))
+        if not _same_features(computed, egm_features.compute_features(ecg_data, progress=False)):
+            raise AssertionError('egm_features.get_features: saved features differ from compute_features')
+    print('{:<40} loaded  {:9.4f} s   appended  {:9.4f} s   ({} points)'.format(
+        'egm_features.get_features x{}'.format(points), loaded, append_time, points - points * 3 // 4))
+
+
+def reference_filter(ecg_data, sos):
+    # per point and channel zero-phase filtering
+    return np.array([[signal.sosfiltfilt(sos, egm) for egm in point] for point in ecg_data])
+
+
+def bench_filters(points=500, seed=0):
+    rng = np.random.default_rng(seed)
+    ecg_data = np.stack([np.stack([make_egm(rng, cycle=300 + (point % 50) * 10 + channel * 3)
+                                   for channel in range(len(cartoutils.Mapping_Channels))])
+                         for point in range(points)])
+    parameters = dict(bandpass=filters.ECG_BANDPASS, notch=50)
+    bench('filter_signals bandpass + notch x{}'.format(points),
+          lambda: filters.filter_signals(ecg_data, **parameters),
+          lambda: reference_filter(ecg_data, filters.make_filter(**parameters)), repeat=1,
+          compare=lambda current, reference: np.allclose(current, reference))
+    # peak memory of the chunked filtering in place and of one call on the whole array
+    for name, run in (('in place, chunked', lambda: filters.filter_signals(ecg_data.copy(), in_place=True,
+                                                                            **parameters)),
+                      ('new array, one call', lambda: filters.filter_signals(ecg_data.copy(), chunk_points=None,
+                                                                              **parameters))):
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('{:<40} data {:8.1f} MB   peak {:8.1f} MB (with the copy of data)'.format(
+            'filter_signals ' + name, ecg_data.nbytes / 1e6, peak / 1e6))
+
+
+def reference_rolling_correlation(channels, window=3):
+    """
+    previous pandas implementation of simple.correlate for every pair of channels
+    windows without variance give NaN or +-inf (rounding) in pandas, inf is replaced by NaN
+    """
+    correlation = [pd.Series(channels[i]).rolling(window).corr(pd.Series(channels[j])).to_numpy()
+                   for i, j in itertools.combinations(range(len(channels)), 2)]
+    return np.nan_to_num(np.array(correlation), nan=np.nan, posinf=np.nan, neginf=np.nan)
+
+
+def bench_rolling_correlation(ep_filename, samples=200000):
+    channels = simple.get_channels(ep_filename, range(8), end=samples)[0]
+    for window in (3, 500):
+        bench('rolling_correlation {} samples, 28 pairs, window {}'.format(samples, window),
+              lambda: simple.rolling_correlation(channels, window)[0],
+              lambda: reference_rolling_correlation(channels, window), repeat=1,
+              compare=lambda current, reference: np.allclose(current, reference, atol=1e-7, equal_nan=True))
+
+
+def draw_channels(lines):
+    # renders the (x, y) lines of the channels as simple.plot_channels does, returns the y limits of the axes
+    figure = Figure()
+    axs = figure.add_gridspec(len(lines), hspace=0.7).subplots(sharex=True)
+    for ax, (x, y) in zip(axs, lines):
+        ax.plot(x, y)
+    FigureCanvasAgg(figure).draw()
+    return np.array([ax.get_ylim() for ax in axs])
+
+
+def bench_plot_pyramid(ep_filename, channel_range=range(8)):
+    # drawing of the whole recording and of a zoomed window from the decimation pyramid and from all samples,
+    # the envelope keeps the extremes, so the y limits are the same
+    channels = simple.get_channels(ep_filename, channel_range)[0]
+    samples = np.arange(channels.shape[1])
+    pyramid = simple.make_pyramid(channels)
+    start_time = timeit.default_timer()
+    simple.decimate(pyramid)
+    build_time = timeit.default_timer() - start_time
+
+    def decimated(window):
+        x, values = simple.decimate(pyramid, window.start or 0, window.stop)
+        return [(x, y) for y in values]
+
+    for name, window in (('whole', slice(None)), ('zoom 1/10', slice(0, channels.shape[1] // 10))):
+        bench('plot_channels {} samples {}'.format(channels.shape[1], name),
+              lambda: draw_channels(decimated(window)),
+              lambda: draw_channels([(samples[window], y) for y in channels[:, window]]), repeat=1)
+    print('{:<40} {:9.4f} s for the levels of the whole recording'.format('make_pyramid', build_time))
+
+
+def reference_interpolate(values, times, new_times):
+    # per point and channel np.interp, NaN outside the samples of the point
+    result = np.empty(values.shape[:2] + new_times.shape[1:])
+    for point in range(len(values)):
+        valid = ~np.isnan(times[point])
+        for channel in range(values.shape[1]):
+            result[point, channel] = np.interp(new_times[point], times[point, valid], values[point, channel, valid],
+                                               left=np.nan, right=np.nan)
+    return result
+
+
+def bench_alignment(zip_filename):
+    cf_data, ecg_data = cartoutils.get_study_data_from_zip(zip_filename, progress=False, cf_cols=alignment.ALIGN_COLS,
+                                                           cf_time=0)
+    cf_times, ecg_times = alignment.get_timeline(cf_data)
+    bench('alignment.interpolate CF on ECG x{}'.format(len(cf_data)),
+          lambda: alignment.interpolate(cf_data[:, 2:], cf_times, ecg_times),
+          lambda: reference_interpolate(cf_data[:, 2:], cf_times, ecg_times),
+          compare=lambda current, reference: np.allclose(current, reference, equal_nan=True))
+
+
+def bench_memory(zip_filename, study_points=5000):
+    # peak memory of loading a study and size of the arrays for every dtype policy,
+    # the compact arrays must hold the same values as the float64 arrays
+    results = {}
+    for policy in cartoutils.DTYPE_POLICIES:
+        tracemalloc.start()
+        results[policy] = cartoutils.get_study_data_from_zip(zip_filename, progress=False, dtype=policy)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        cf_data, ecg_data = results[policy]
+        point_bytes = (cf_data.nbytes + ecg_data.nbytes) / max(len(ecg_data), 1)
+        print('{:<40} arrays {:8.1f} MB   peak {:8.1f} MB   {} points {:8.1f} MB'.format(
+            'get_study_data_from_zip dtype={}'.format(policy), (cf_data.nbytes + ecg_data.nbytes) / 1e6,
+            peak / 1e6, study_points, point_bytes * study_points / 1e6))
+    for policy, (cf_data, ecg_data) in results.items():
+        if not (np.array_equal(ecg_data, results['float64'][1])
+                and np.array_equal(cf_data, results['float64'][0].astype(cf_data.dtype))):
+            raise AssertionError('dtype={}: values differ from the float64 arrays'.format(policy))
+
+
+def bench_binary_cache(zip_filename, ep_filename, cache_dir):
+    # first call parses the text files and fills the cache, the following calls read the binary cache
+    binary_cache.CACHE_DIR, binary_cache.ENABLED = cache_dir, True
+    binary_cache.clear()
+    # a window read with the sample index does not parse the whole file into the cache
+    start_time = timeit.default_timer()
+    window = simple.get_channels(ep_filename, start=50000, end=50900, use_index=True)[0]
+    print('{:<40} current {:9.4f} s   cache {} bytes'.format('get_channels use_index=True (cache on)',
+                                                            timeit.default_timer() - start_time,
+                                                            binary_cache.get_stats()["bytes"]))
+    if binary_cache.get_stats()["bytes"] != 0:
+        raise AssertionError('get_channels use_index=True: the window read filled the cache')
+    for name, load in (('get_study_data_from_zip',
+                        lambda: cartoutils.get_study_data_from_zip(zip_filename, progress=False)),
+                       ('get_channels whole file', lambda: simple.get_channels(ep_filename))):
+        start_time = timeit.default_timer()
+        parsed = load()
+        parse_time = timeit.default_timer() - start_time
+        cached_time = min(timeit.repeat(load, number=1, repeat=3))
+        if not all(np.array_equal(p, c) if isinstance(p, np.ndarray) else p == c for p, c in zip(parsed, load())):
+            raise AssertionError('{}: cached results differ from the parsed results'.format(name))
+        print('{:<40} cached  {:9.4f} s   parsed    {:9.4f} s   speedup x{:.1f}'
+              .format(name + ' (cache)', cached_time, parse_time, parse_time / cached_time))
+    if not np.array_equal(simple.get_channels(ep_filename, start=50000, end=50900, use_index=True)[0], window):
+        raise AssertionError('get_channels use_index=True: the window from the cache differs')
+    print('binary cache: {}'.format(binary_cache.get_stats()))
+    # overwriting an entry replaces its size in the counted size of the cache
+    binary_cache.put('ep', ep_filename, *binary_cache.get('ep', ep_filename))
+    if binary_cache.get_stats()["bytes"] != sum(size for _, size, _ in binary_cache._list_entries()):
+        raise AssertionError('binary_cache.put: the counted size differs from the size of the entries')
+
+    # a zip archive opened from memory has no path, its files are parsed without the cache
+    cf_files, ecg_files = cartoutils.get_files_from_zip(zip_filename)
+    with open(zip_filename, 'rb') as file, ZipFile(io.BytesIO(file.read())) as zip_file, \
+            ZipFile(zip_filename) as disk_zip_file:
+        for read, filename in ((cartoutils.get_contact_data_from_zipped_txt, cf_files[0]),
+                               (cartoutils.get_ecg_data_from_zipped_txt, ecg_files[0])):
+            if not np.array_equal(read(zip_file, filename), read(disk_zip_file, filename), equal_nan=True):
+                raise AssertionError('{}: zip archive from BytesIO differs from the file'.format(read.__name__))
+    binary_cache.ENABLED = False
+
+
+def reference_plot_data(ecg_data, filename, speed=0):
+    """
+    previous ecg_writer.plot_data: the paper is read and the figure is built for every page,
+    the page is saved as jpg and read back
+    """
+    img = ecg_writer.plt.imread("ecg-paper.jpg")
+    graph = ecg_writer.Figure(layout='constrained', figsize=(24.5, 17.4), dpi=90)
+    ecg_writer.FigureCanvasAgg(graph)
+    paper_axes = graph.add_subplot()
+    paper_axes.imshow(img)
+    paper_axes.axis('off')
+    axs = graph.add_gridspec(14, hspace=0).subplots(sharex=True, sharey=True)
+    if speed == 0:
+        speed = int(250000/len(ecg_data[0][0]))
+    for ax in axs:
+        ax.axis('off')
+        ax.set_xmargin(0.1)
+    for i, d in enumerate(ecg_data[0]):
+        axs[i + 1].plot(d[:int(250000/speed)], 'k-', linewidth=1.7, clip_on=False)
+        axs[i + 1].annotate(ecg_data[1][i], (0, 320), size='22')
+    ecg_writer.draw_on_ecg(paper_axes, speed)
+    with warnings.catch_warnings():  # constrained layout of the 14 axes without height, as in the previous version
+        warnings.simplefilter('ignore', UserWarning)
+        graph.savefig(filename, format='jpg')
+    return ecg_writer.Image.open(filename).convert('RGB')
+
+
+def _same_pages(current, reference, mean_tolerance=4, max_tolerance=64):
+    # the reference pages went through JPEG, the pixels may differ by the compression noise only
+    for c, r in zip(current, reference):
+        if c.size != r.size:
+            return False
+        difference = np.abs(np.asarray(c, dtype=int) - np.asarray(r, dtype=int))
+        if difference.mean() > mean_tolerance or np.mean(difference > max_tolerance) > 1e-4:
+            return False
+    return len(current) == len(reference)
+
+
+def bench_ecg_writer(tmp_dir, pages=10, seed=0):
+    # pages of 12 leads, the current renderer reuses one figure, the reference builds a figure per page
+    rng = np.random.default_rng(seed)
+    leads = 'I', 'II', 'III', 'aVR', 'aVL', 'aVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6'
+    ecg_datas = [(np.cumsum(rng.integers(-30, 31, (12, cartoutils.ECG_SAMPLES)), axis=1), leads)
+                 for _ in range(pages)]
+    ecg_writer.plot_data(ecg_datas[0], show=False)  # the figure and the background are made once
+    filename = os.path.join(tmp_dir, 'page.jpg')
+    bench('ecg_writer.plot_data {} pages'.format(pages),
+          lambda: [ecg_writer.plot_data(ecg_data, show=False) for ecg_data in ecg_datas],
+          lambda: [reference_plot_data(ecg_data, filename) for ecg_data in ecg_datas], repeat=1,
+          compare=_same_pages)
+    start_time = timeit.default_timer()
+    ecg_writer.plot_pages(ecg_datas * 5, os.path.join(tmp_dir, 'pages.pdf'))
+    print('{:<40} current {:9.4f} s   {:.1f} MB'.format(
+        'ecg_writer.plot_pages {} pages pdf'.format(5 * pages), timeit.default_timer() - start_time,
+        os.path.getsize(os.path.join(tmp_dir, 'pages.pdf')) / 1e6))
+
+
+def bench_printouts(tmp_dir, points=20):
+    # throughput of the batch printouts of a study, serially and in a process pool,
+    # the printouts must not depend on the number of workers
+    zip_filename = make_study_zip(os.path.join(tmp_dir, 'printout_study.zip'), points=points)
+    outputs = {}
+    pool_workers = max(os.cpu_count() or 1, 2)
+    for workers in (1, pool_workers):
+        start_time = timeit.default_timer()
+        filenames = ecg_writer_small.write_printouts(
+            zip_filename, os.path.join(tmp_dir, 'printouts_{}'.format(workers)), workers=workers)
+        elapsed = timeit.default_timer() - start_time
+        outputs[workers] = [(os.path.basename(filename), open(filename, 'rb').read()) for filename in filenames]
+        print('{:<40} {:6.2f} sheets/s ({} sheets in {:.2f} s)'.format(
+            'write_printouts workers={}'.format(workers), len(filenames) / elapsed, len(filenames), elapsed))
+    if outputs[1] != outputs[pool_workers]:
+        raise AssertionError('write_printouts: printouts differ between serial and parallel runs')
+
+
+def main(zip_filename=None):
+    # the parsers are compared with the binary cache disabled
+    binary_cache.ENABLED = False
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if zip_filename is None:
+            zip_filename = make_study_zip(os.path.join(tmp_dir, 'synthetic_study.zip'))
+        ep_filename = make_ep_export(os.path.join(tmp_dir, 'synthetic_ep.txt'))
+        bench_ecg_parser(zip_filename)
+        bench_study_loading(zip_filename)
+        bench_get_channels(ep_filename)
+        bench_rolling_correlation(ep_filename)
+        bench_plot_pyramid(ep_filename)
+        bench_alignment(zip_filename)
+        bench_filters()
+        bench_memory(zip_filename)
+        bench_template_matching()
+        bench_search()
+        bench_search_pool()
+        bench_egm_index()
+        bench_egm_features()
+        bench_binary_cache(zip_filename, ep_filename, os.path.join(tmp_dir, 'cache'))
+        bench_ecg_writer(tmp_dir)
+        bench_printouts(tmp_dir)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# parsed text exports are cached as compact binary arrays (.npy) with the header as .json
+# a cache entry is keyed by the source path, its size and modification time, so a changed file is parsed again
+# the cache is off by default, CARTO_CACHE=1 (or binary_cache.ENABLED = True) turns it on,
+# otherwise bulk ingestion (zip_to_npy, zip_to_store) would keep a second copy of every study in the cache
+ENABLED = os.environ.get('CARTO_CACHE', '0') == '1'
+CACHE_DIR = os.environ.get('CARTO_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'cartoegms'))
+MAX_BYTES = int(os.environ.get('CARTO_CACHE_MAX_BYTES', 4 * 1024 ** 3))  # least recently used entries are evicted
+
+stats = {"hits": 0, "misses": 0, "evictions": 0}
+_cache_bytes = None  # total size of the cache, scanned on the first store
+
+
+def get_stats():
+    """
+    :return: copy of the hit/miss/eviction counters and the current size of the cache in bytes
+    """
+    return dict(stats, bytes=_get_cache_bytes())
+
+
+def clear():
+    """
+    removes all cache entries and resets the counters
+    """
+    global _cache_bytes
+    for npy_file, _, _ in _list_entries():
+        _remove_entry(npy_file)
+    _cache_bytes = 0
+    stats.update(hits=0, misses=0, evictions=0)
+
+
+def _get_key(kind, source, member=None):
+    # kind separates different parsers of the same file, member is the name of the file in a zip archive
+    # returns None if the source is not a file on disk (e.g. a zip archive opened from BytesIO), it is not cached
+    if not isinstance(source, (str, bytes, os.PathLike)) or not os.path.isfile(source):
+        return None
+    stat = os.stat(source)
+    key = '{}|{}|{}|{}|{}'.format(kind, os.path.abspath(source), member, stat.st_size, stat.st_mtime_ns)
+    return os.path.join(CACHE_DIR, hashlib.sha1(key.encode('utf8')).hexdigest())
+
+
+def _compact(data):
+    # integers are stored in the smallest of int16/int32 that holds them, floats as float32 if no value changes,
+    # so the data returned from the cache is always identical to the parsed data
+    if np.issubdtype(data.dtype, np.integer):
+        for dtype in (np.int16, np.int32):
+            info = np.iinfo(dtype)
+            if data.size == 0 or (data.min() >= info.min and data.max() <= info.max):
+                return data.astype(dtype)
+    elif np.issubdtype(data.dtype, np.floating):
+        compact = data.astype(np.float32)
+        if np.array_equal(compact, data, equal_nan=True):
+            return compact
+    return data
+
+
+def get(kind, source, member=None, mmap_mode=None):
+    """
+    :param kind: name of the parser, e.g. 'ecg'
+    :param source: path of the text file (or of the zip archive), other sources are not cached
+    :param member: name of the file in the zip archive
+    :param mmap_mode: passed to np.load, 'r' to read only the used part of large arrays
+    :return: (data, header) or None if the file is not cached
+    """
+    key = _get_key(kind, source, member) if ENABLED else None
+    if key is None:
+        return None
+    try:
+        data = np.load(key + '.npy', mmap_mode=mmap_mode)
+        with open(key + '.json', 'r') as file:
+            header = json.load(file)
+    except (OSError, ValueError):
+        stats["misses"] += 1
+        return None
+    os.utime(key + '.npy')  # the modification time of the entry is its last use
+    stats["hits"] += 1
+    return data, header
+
+
+def put(kind, source, data, header, member=None):
+    """
+    stores the parsed data and header, evicts the least recently used entries if the cache is full
+    :param kind: name of the parser, e.g. 'ecg'
+    :param source: path of the text file (or of the zip archive)
+    :param data: parsed Numpy array
+    :param header: JSON serializable header
+    :param member: name of the file in the zip archive
+    """
+    global _cache_bytes
+    key = _get_key(kind, source, member) if ENABLED else None
+    if key is None:
+        return
+    cache_bytes = _get_cache_bytes()  # scanned before the new entry is written
+    for filename in (key + '.npy', key + '.json'):
+        if os.path.exists(filename):  # the entry is overwritten, its old size is replaced
+            cache_bytes -= os.path.getsize(filename)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(key + '.json', 'w') as file:
+            json.dump(header, file)
+        np.save(key + '.tmp.npy', _compact(data))
+        os.replace(key + '.tmp.npy', key + '.npy')
+    except OSError:
+        return  # the cache is optional, e.g. read-only location
+    _cache_bytes = cache_bytes + os.path.getsize(key + '.npy') + os.path.getsize(key + '.json')
+    if _cache_bytes > MAX_BYTES:
+        _evict()
+
+
+def _list_entries():
+    # (npy file, size of the entry, last use) of all entries
+    if not os.path.isdir(CACHE_DIR):
+        return []
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith('.npy') and not name.endswith('.tmp.npy'):
+            npy_file = os.path.join(CACHE_DIR, name)
+            try:
+                stat = os.stat(npy_file)
+                size = stat.st_size + os.path.getsize(npy_file[:-4] + '.json')
+            except OSError:
+                continue
+            entries.append((npy_file, size, stat.st_mtime))
+    return entries
+
+
+def _remove_entry(npy_file):
+    for filename in (npy_file, npy_file[:-4] + '.json'):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+def _get_cache_bytes():
+    global _cache_bytes
+    if _cache_bytes is None:
+        _cache_bytes = sum(size for _, size, _ in _list_entries())
+    return _cache_bytes
+
+
+def _evict():
+    # removes the least recently used entries until the cache is below MAX_BYTES
+    global _cache_bytes
+    entries = sorted(_list_entries(), key=lambda entry: entry[2])
+    _cache_bytes = sum(size for _, size, _ in entries)
+    for npy_file, size, _ in entries:
+        if _cache_bytes <= MAX_BYTES:
+            break
+        _remove_entry(npy_file)
+        _cache_bytes -= size
+        stats["evictions"] += 1
@@ -1,17 +1,36 @@
+import copy
 import glob
+import hashlib
+import json
 import re
+from datetime import datetime
 import numpy as np
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from zipfile import ZipFile, is_zipfile
 from matplotlib import pyplot as plt
 from tqdm import tqdm
-from numpy import ndarray
 from tkinter import Tk
 from tkinter import filedialog
 
+import binary_cache
+
 CF_SAMPLES = 200
+CF_WINDOW = 50  # samples of contact force per point (Time >= 0 ms at 50 Hz)
 ECG_SAMPLES = 2500
 Mapping_Channels = ['M1', 'M2', 'M3', 'M4', 'M1-M2', 'M3-M4']
+MANIFEST_FILE = 'manifest.json'
+CHECKPOINT_POINTS = 500  # points between saved checkpoints of the incremental zip_to_npy
+# one row per point, saved alongside the cf/ecg arrays
+METADATA_DTYPE = np.dtype([('map', 'U32'),              # name of the Carto map, e.g. '1-Map'
+                           ('point', 'i4'),             # point number, e.g. 30 for '1-Map_P30'
+                           ('time', 'datetime64[s]'),   # Date + Point Time from the ContactForce header
+                           ('source', 'U64'),           # name of the zip archive (or directory)
+                           ('gain', 'f8', (len(Mapping_Channels),))])  # mV per ecg unit of every Mapping_Channel
+# dtypes of the (cf, ecg) arrays, 'float64' are the original arrays, 'compact' keeps the contact force as float32
+# and the integer ecg samples as int16 (4x less memory than float64), ecg_to_mv() converts them to mV when needed
+DTYPE_POLICIES = {'float64': (np.float64, np.float64),
+                  'compact': (np.float32, np.int16)}
 
 
 def get_zip_files_paths(directory):
@@ -54,12 +73,39 @@ def get_paths(epdata_dir):
         return zip_files
 
 
-def clean_zip(zip_filename, clean_folder_name='/clean'):
+def _copy_zip_member_raw(zip_file, new_zip, info):
+    """
+    copies the compressed bytes of a member into new_zip without decompressing and compressing again
+    zipfile has no public API for this, so the local header is written with ZipInfo.FileHeader()
+    :param zip_file: opened source zip object
+    :param new_zip: zip object opened for writing
+    :param info: ZipInfo of the member in zip_file
+    """
+    zip_file.fp.seek(info.header_offset)
+    local_header = zip_file.fp.read(30)
+    # skip the local file header: 30 bytes + file name length + extra field length
+    zip_file.fp.seek(int.from_bytes(local_header[26:28], 'little') + int.from_bytes(local_header[28:30], 'little'), 1)
+    raw_data = zip_file.fp.read(info.compress_size)
+
+    new_info = copy.copy(info)
+    new_info.flag_bits &= ~0x08  # sizes and CRC are known, no data descriptor after the data
+    new_info.header_offset = new_zip.fp.tell()
+    new_zip.fp.write(new_info.FileHeader())
+    new_zip.fp.write(raw_data)
+    new_zip.start_dir = new_zip.fp.tell()
+    new_zip.filelist.append(new_info)
+    new_zip.NameToInfo[new_info.filename] = new_info
+    new_zip._didModify = True
+
+
+def clean_zip(zip_filename, clean_folder_name='/clean', raw_copy=False):
     """
     searches for contact_force + corresponding ecg files
     creates new zip archive and copies found files pairwise into a '/clean subdirectory
     :param clean_folder_name: specify where to save cleaned zips
     :param zip_filename:
+    :param raw_copy: copy the compressed data of the files as is, without decompressing and compressing again
+            (not possible for encrypted files, they are copied the usual way)
     :return: number of contact_force files found or 0 if file is already clean version
     """
     if not is_zipfile(zip_filename):
@@ -88,27 +134,31 @@ def clean_zip(zip_filename, clean_folder_name='/clean'):
         corresponding_ecg_files_count = 0
         ecg_files_count = 0
 
-        # iteration though all files in zip archive
+        # one pass over all files in zip archive: ecg files are indexed by (map, point)
+        ecg_files = {}
+        for filename in filename_list:
+            ecg_file = re.search('(.*)_P(.*)_ECG_Export.txt', filename)
+            if ecg_file:
+                ecg_files_count += 1
+                ecg_files.setdefault(ecg_file.groups(), filename)
+
+        # iteration though all contact force files in zip archive
         with tqdm(total=len(filename_list), desc="Cleaning …", ascii=False, ncols=150) as pbar:
             for filename in filename_list:
                 cf_file = re.search('(.*)_P(.*)_ContactForce.txt', filename)
-                ecg_file = re.search('(.*)_P(.*)_ECG_Export.txt', filename)
                 pbar.update(1)
-                if ecg_file:
-                    ecg_files_count += 1
                 if cf_file:
                     contact_files_count += 1
                     # check for the ecg pair
-                    for filename2 in filename_list:
-                        ecg_filename = re.match(filename.replace('ContactForce.txt', '') + 'ECG_Export.txt', filename2)
-                        if ecg_filename:
-                            cf_data = zipfile.read(filename)
-                            ecg_data = zipfile.read(filename2)
-                            new_zip.writestr(zipfile.getinfo(filename), cf_data)
-                            # print(zipfile.getinfo(filename))
-                            new_zip.writestr(zipfile.getinfo(filename2), ecg_data)
-                            # print(zipfile.getinfo(filename2))
-                            corresponding_ecg_files_count += 1
+                    filename2 = ecg_files.get(cf_file.groups())
+                    if filename2:
+                        for member in (filename, filename2):
+                            info = zipfile.getinfo(member)
+                            if raw_copy and not info.flag_bits & 0x01:
+                                _copy_zip_member_raw(zipfile, new_zip, info)
+                            else:
+                                new_zip.writestr(info, zipfile.read(member))
+                        corresponding_ecg_files_count += 1
         new_zip.close()
 
         print('\n', 'total contact points found = ', contact_files_count)
@@ -133,9 +183,10 @@ def get_files(search_dir, lim=None):
         for i, name in enumerate(glob_result):
             if lim is None or (lim and i < lim):
                 result = re.search('(.*)_P(.*)_ContactForce.txt', name)
-                current_map = result.group(1).split('\\')[1]
+                current_map = os.path.basename(result.group(1))
                 current_point = result.group(2)
-                corresponding_ecg_file = search_dir + "\\{}_P{}_ECG_Export.txt".format(current_map, current_point)
+                corresponding_ecg_file = os.path.join(search_dir, "{}_P{}_ECG_Export.txt".format(current_map,
+                                                                                                 current_point))
                 if glob.glob(corresponding_ecg_file):
                     contact_file_list.append(name)
                     ecg_file_list.append(corresponding_ecg_file)
@@ -182,172 +233,338 @@ def get_files_from_zip(zip_filename):
     return contact_file_list, ecg_file_list
 
 
-def get_contact_data(filename, start=150, cols=[3, 4, 5]):
+def parse_contact_force_file(text):
+    """
+    parses the whole _ContactForce.txt file in one pass
+    searches for the names of the columns of the table (line starting with 'Index\tTime'),
+    reads the whole table below with a single np.fromstring call and the header fields above it
+    :param text: content of the cf_file (str or bytes)
+    :return: header dictionary, list of column names, Numpy array with shape = (#of samples, len(column names))
+             header: fields of the 2nd line (see parse_contact_force_header) and of the 'Name=value' lines,
+             the numbers in the line after a 'Name=value' line are saved as name_values, e.g.
+             {'rate': 50, 'number': 200, 'date': '05/05/21', ..., 'mode': 0,
+              'intervalgraph': 100, 'intervalgraph_values': [3381123.0, 0.321241, 0.0, ...],
+              'intervalnongraph': 1000, 'intervalnongraph_values': [3381573.0, 0.734095, 0.0, ...]}
+    """
+    if isinstance(text, bytes):
+        text = text.decode('utf8')
+    table_start = re.search(r'^Index\tTime\t.*$', text, re.MULTILINE)
+    if table_start is None:
+        raise ValueError('No Index/Time table in the contact force file')
+    column_names = table_start.group(0).split()
+    data = np.fromstring(text[table_start.end():], dtype=float, sep=' ')
+
+    header = {}
+    name = None
+    for i, line in enumerate(text[:table_start.start()].splitlines()[1:]):
+        if i == 0 or '=' in line:
+            fields = parse_contact_force_header(line)
+            header.update(fields)
+            name = list(fields)[-1] if fields and i > 0 else None
+        elif name is not None and line.strip():
+            header[name + '_values'] = np.fromstring(line, dtype=float, sep=' ').tolist()
+            name = None
+    return header, column_names, data.reshape(-1, len(column_names))
+
+
+def select_contact_window(table, start=150, cols=[3, 4, 5], time=None, samples=CF_WINDOW):
+    """
+    fixed-shape window of the contact force table, the points of a study can be stacked
+    :param table: contact force table, see parse_contact_force_file()
+    :param start: first row of the window, used if time is None
+    :param cols: columns of the table, see get_contact_data()
+    :param time: first relative time of the window in ms (Time column), e.g. time=0 takes the samples with
+            Time >= 0 whatever the number of samples before 0
+    :param samples: number of samples of the window, a table ending before the end of the window is padded with NaN
+    :return: Numpy array with shape = (len(cols), samples)
+    """
+    if time is not None:
+        later = np.flatnonzero(table[:, 1] >= time)
+        start = later[0] if len(later) else len(table)
+    window = np.full((len(cols), samples), np.nan)
+    rows = table[start:start + samples, cols].T
+    window[:, :rows.shape[1]] = rows
+    return window
+
+
+def _get_contact_file(source, read_text, member=None):
+    # parsed contact force header and table from the binary cache, the text is read and parsed only on a cache miss
+    cached = binary_cache.get('contact_force', source, member)
+    if cached is not None:
+        return cached[1]["header"], cached[0].astype(float)
+    header, column_names, table = parse_contact_force_file(read_text())
+    binary_cache.put('contact_force', source, table, {"columns": column_names, "header": header}, member)
+    return header, table
+
+
+def get_contact_data(filename, start=150, cols=[3, 4, 5], time=None, samples=CF_WINDOW, header=False):
     """
     Directory version
     :param filename: _ContactForce.txt file to get data from
     :param start: positive time values start after index 150
     :param cols: cols: col0 = Index, col1 = relative time, col2 = timestamp, col3 = ForceValue, col4 = AxialAngle,
             col5 = LateralAngle, col6 = MetalSeverity, col7 = InAccurateSeverity, col8 = NeedZeroing
-    :return: Numpy array with shape = (len(cols), 50) if start=150
+    :param time: select the window by relative time in ms instead of start, see select_contact_window()
+    :param samples: number of samples, missing samples at the end of the file are NaN
+    :param header: return also the header of the file, see parse_contact_force_file()
+    :return: Numpy array with shape = (len(cols), samples)
     """
-    file = open(filename, 'r')
-    lines = file.readlines()
-    read_data = False
-    contact_data = np.empty((0, len(cols)), int)
+    def read_text():
+        with open(filename, 'r') as file:
+            return file.read()
 
-    for i, line in enumerate(lines):
-        if read_data:
-            newline = np.fromstring(line, dtype=float, sep=' ')
-            newline = np.take(newline, cols, 0)
-            contact_data = np.append(contact_data, [newline], axis=0)
-        if i == 7 + start:
-            read_data = True
-        # inogda v faile ne 200, a 201 sampl!! poetomu limit na 50
-        if i >= 7 + start + 50:
-            break
+    # inogda v faile ne 200, a 201 sampl!! poetomu limit na 50
+    cf_header, table = _get_contact_file(filename, read_text)
+    cf_data = select_contact_window(table, start, cols, time, samples)
+    return (cf_data, cf_header) if header else cf_data
 
-    return np.transpose(contact_data)
 
-
-def get_contact_data_from_zipped_txt(zip_file, cf_filename, start=150, cols=[3, 4, 5]):
+def get_contact_data_from_zipped_txt(zip_file, cf_filename, start=150, cols=[3, 4, 5], time=None,
+                                     samples=CF_WINDOW, header=False):
     """
     Zip version
-    iterates through the cf_file and collects contact force data
+    collects contact force data from the cf_file
     :param zip_file: opened zip object
     :param cf_filename: name of the cf_file in zip archive
     :param start: positive time values start after index 150
     :param cols: col0 = Index, col1 = relative time, col2 = timestamp, col3 = ForceValue, col4 = AxialAngle,
             col5 = LateralAngle, col6 = MetalSeverity, col7 = InAccurateSeverity, col8 = NeedZeroing
-    :return: Numpy array with shape = (len(cols), 50) if start=150
+    :param time: select the window by relative time in ms instead of start, see select_contact_window()
+    :param samples: number of samples, missing samples at the end of the file are NaN
+    :param header: return also the header of the file, see parse_contact_force_file()
+    :return: Numpy array with shape = (len(cols), samples)
     """
+    if cf_filename not in zip_file.namelist():
+        raise NameError('File {} not found in zip archive!'.format(cf_filename))
+    # if number of samples in file exceeds CF_SAMPLES only the window of samples is taken
+    cf_header, table = _get_contact_file(zip_file.filename, lambda: zip_file.read(cf_filename), cf_filename)
+    cf_data = select_contact_window(table, start, cols, time, samples)
+    return (cf_data, cf_header) if header else cf_data
 
-    if cf_filename in zip_file.namelist():
-        lines = zip_file.read(cf_filename).splitlines()
-        read_data = False  # start read data skipping the headers
-        contact_data = np.empty((0, len(cols)), int)
 
-        for i, line in enumerate(lines):
-            if read_data:
-                newline = np.fromstring(line, dtype=float, sep='\t')
-                newline = np.take(newline, cols, 0)
-                contact_data = np.append(contact_data, [newline], axis=0)
+def parse_contact_force_header(line):
+    """
+    parses the 2nd line of the _ContactForce.txt file
+    'Rate=50\tNumber =200\tDate:05/05/21\tPoint Time:14:27:09\tSystem Time:14:27:09'
+    :param line: header line (str or bytes)
+    :return: dictionary e.g. {'rate': 50, 'number': 200, 'date': '05/05/21', 'point_time': '14:27:09', ...}
+    """
+    if isinstance(line, bytes):
+        line = line.decode('utf8')
+    header = {}
+    for field in line.split('\t'):
+        subfield = re.split('[=:]', field, 1)
+        if len(subfield) != 2:
+            continue
+        var = subfield[0].strip().lower().replace(" ", "_")
+        val = subfield[1].strip()
+        try:
+            val = int(val)
+        except ValueError:
+            pass
+        header[var] = val
+    return header
+
+
+def get_dtypes(dtype='float64'):
+    """
+    :param dtype: name of the policy in DTYPE_POLICIES or a tuple (cf dtype, ecg dtype)
+    :return: (cf dtype, ecg dtype) as numpy dtypes
+    """
+    if isinstance(dtype, str):
+        if dtype not in DTYPE_POLICIES:
+            raise ValueError('Unknown dtype policy {}, use one of {}'.format(dtype, list(DTYPE_POLICIES)))
+        dtype = DTYPE_POLICIES[dtype]
+    cf_dtype, ecg_dtype = dtype
+    return np.dtype(cf_dtype), np.dtype(ecg_dtype)
+
 
-            if i == 7 + start:
-                read_data = True
-            if i >= 7 + start + 50:  # if number of samples in file exceeds CF_SAMPLES
-                break
-    return contact_data.T
+def _check_range(data, dtype):
+    # numpy wraps integers around when they are assigned into a smaller integer array, so the values are checked
+    if np.issubdtype(dtype, np.integer) and data.size:
+        info = np.iinfo(dtype)
+        if data.min() < info.min or data.max() > info.max:
+            raise ValueError('values out of the {} range'.format(np.dtype(dtype).name))
+    return data
 
 
-def get_ecg_data(filename):
+def ecg_to_mv(ecg_data, meta_data):
+    """
+    converts ecg data to mV with the gain of the ecg export, e.g. for a slice of memory-mapped compact data
+    :param ecg_data: ecg data with the shape = (#of points, len(Mapping_channels), 2500)
+    :param meta_data: metadata of the points (array of METADATA_DTYPE)
+    :return: float Numpy array of the same shape
+    """
+    return ecg_data * meta_data['gain'][:, :, np.newaxis]
+
+
+def empty_metadata(count):
+    """
+    :param count: number of points
+    :return: array of METADATA_DTYPE with empty rows (no point number, time or gain)
+    """
+    meta_data = np.zeros(count, METADATA_DTYPE)
+    meta_data['time'] = np.datetime64('NaT')
+    meta_data['point'] = -1
+    meta_data['gain'] = np.nan
+    return meta_data
+
+
+def point_map_name(point_id):
+    """
+    :param point_id: name of the point file without _ContactForce.txt, e.g. '1-Map_P30'
+    :return: name of the map, e.g. '1-Map'
+    """
+    return point_id.rsplit('_P', 1)[0]
+
+
+def get_point_metadata(point_id, cf_header, source, ecg_header=None):
+    """
+    :param point_id: name of the point file without _ContactForce.txt, e.g. '1-Map_P30'
+    :param cf_header: header of the contact force file, see parse_contact_force_file()
+    :param source: name of the zip archive (or directory) of the point
+    :param ecg_header: header of the ecg file, see get_ecg_data(header=True)
+    :return: one row of METADATA_DTYPE
+    """
+    point = point_id.rsplit('_P', 1)[-1]
+    try:
+        time = np.datetime64(datetime.strptime('{} {}'.format(cf_header['date'], cf_header['point_time']),
+                                               '%m/%d/%y %H:%M:%S'), 's')
+    except (KeyError, ValueError):
+        time = np.datetime64('NaT', 's')
+    gain = ecg_header.get("gain") if ecg_header else None
+    return np.array((point_map_name(point_id), int(point) if point.isdigit() else -1, time,
+                     os.path.basename(source), np.nan if gain is None else gain), dtype=METADATA_DTYPE)
+
+
+def get_point_lookup(metadata):
+    """
+    :param metadata: array of METADATA_DTYPE
+    :return: dictionary (source, map, point) -> row for O(1) lookup
+    """
+    return {key: row for row, key in enumerate(zip(metadata['source'].tolist(), metadata['map'].tolist(),
+                                                   metadata['point'].tolist()))}
+
+
+def select_points(metadata, map_name=None, point=None, start_time=None, end_time=None, source=None):
+    """
+    vectorized filter on the metadata, all given conditions must be met
+    :param metadata: array of METADATA_DTYPE
+    :param map_name: name of the map
+    :param point: point number or list of point numbers
+    :param start_time: first time (inclusive), e.g. '2021-05-05T14:00'
+    :param end_time: last time (exclusive)
+    :param source: name of the zip archive
+    :return: indexes of the selected rows
+    """
+    mask = np.ones(len(metadata), bool)
+    if map_name is not None:
+        mask &= metadata['map'] == map_name
+    if point is not None:
+        mask &= np.isin(metadata['point'], point)
+    if start_time is not None:
+        mask &= metadata['time'] >= np.datetime64(start_time, 's')
+    if end_time is not None:
+        mask &= metadata['time'] < np.datetime64(end_time, 's')
+    if source is not None:
+        mask &= metadata['source'] == os.path.basename(source)
+    return np.flatnonzero(mask)
+
+
+def parse_ecg_table(text):
+    """
+    parses the whole content of an _ECG_Export.txt file in one pass
+    searches for the names of the columns of the table (4th line of the file),
+    then reads the whole data block with a single np.fromstring call
+    :param text: content of the ecg file (str or bytes)
+    :return: header {"channel_names": channel names without channel numbers, "gain": mV per unit (2nd line)},
+             Numpy array with shape = (2500, len(channel names))
+    """
+    if isinstance(text, bytes):
+        text = text.decode('utf8')
+    lines = text.split('\n', 4)
+    gain = re.search(r'gain\)\s*=\s*([-+.\deE]+)', lines[1]) if len(lines) > 1 else None
+
+    # get channel names from the headers of the table and get rid of channel numbers in channel names
+    channel_names = [re.search(r'(.*)\(.', channel_name).group(1) for channel_name in lines[3].split()]
+
+    data = np.fromstring(lines[4] if len(lines) > 4 else '', dtype=int, sep=' ')
+    return {"channel_names": channel_names, "gain": float(gain.group(1)) if gain else None}, \
+        data.reshape(-1, len(channel_names))
+
+
+def _get_ecg_channels(source, read_text, channels=Mapping_Channels, member=None):
+    # ecg channels and the header from the binary cache, the text is read and parsed only on a cache miss
+    cached = binary_cache.get('ecg', source, member)
+    if cached is not None:
+        table, header = cached
+    else:
+        header, table = parse_ecg_table(read_text())
+        binary_cache.put('ecg', source, table, header, member)
+    return table[:, [header["channel_names"].index(channel_name) for channel_name in channels]].T.astype(int), \
+        header
+
+
+def get_ecg_data(filename, header=False):
     """
     Directory version
-    iterates through the ecg file and collects ecg data
+    reads the ecg file and collects ecg data
     searches for the names of the columns of the table
     and extracts data into numpy array
     :param filename: name of the ecg_file
+    :param header: return also the header of the file (channel names and gain), see parse_ecg_table()
     :return: Numpy array with shape = (len(Mapping_channels), 2500)
     """
-    file = open(filename, 'r')
-    lines = file.readlines()
-    read_data = False
-    channels = np.empty((0, 6), int)
+    def read_text():
+        with open(filename, 'r') as file:
+            return file.read()
 
-    for i, line in enumerate(lines):
+    ecg_data, ecg_header = _get_ecg_channels(filename, read_text)
+    return (ecg_data, ecg_header) if header else ecg_data
 
-        d1 = "M1"
-        d2 = "M2"
-        d3 = "M3"
-        d4 = "M4"
-        d5 = "M1-M2"
-        d6 = "M3-M4"
 
-        if read_data:
-            newline = np.fromstring(line, dtype=int, sep=' ')
-            newline = [newline[d1_index], newline[d2_index], newline[d3_index], newline[d4_index], newline[d5_index],
-                       newline[d6_index]]
-            channels = np.append(channels, [newline], axis=0)
-
-        if i == 3:
-            read_data = True
-            channel_names = line.split()
-            for i, c in enumerate(channel_names):
-                result = re.search('(.*)\(.', c)
-                channel_names[i] = result.group(1)
-            d1_index = channel_names.index(d1)
-            d2_index = channel_names.index(d2)
-            d3_index = channel_names.index(d3)
-            d4_index = channel_names.index(d4)
-            d5_index = channel_names.index(d5)
-            d6_index = channel_names.index(d6)
-
-    return np.transpose(channels)
-
-
-def get_ecg_data_from_zipped_txt(zip_file, ecg_filename):
+def get_ecg_data_from_zipped_txt(zip_file, ecg_filename, header=False):
     """
     Zip version
-    iterates through the ecg file and collects ecg data
+    reads the ecg file and collects ecg data
     searches for the names of the columns of the table, corresponding to the Mapping_channel(global list) names
     and extracts data into numpy array
     :param zip_file: opened zip object
     :param ecg_filename: name of the ecg_file in zip archive
+    :param header: return also the header of the file (channel names and gain), see parse_ecg_table()
     :return: Numpy array with shape = (len(Mapping_channels), 2500)
     """
     if ecg_filename in zip_file.namelist():
-        lines = zip_file.read(ecg_filename).splitlines()
-        read_data = False  # start read data skipping the headers
-        ecg_array: ndarray = np.empty((0, len(Mapping_Channels)), int)
-        for i, line in enumerate(lines):
-            # start to read from data field of the table
-            if read_data:
-                newline = np.fromstring(line, dtype=int, sep=' ')
-                channel_data = np.take(newline, channel_indexes, axis=0)
-                ecg_array = np.append(ecg_array, [channel_data], axis=0)
-
-            # read headers of the table in ecg file
-            if i == 3:
-                read_data = True
-                channel_indexes = []
-
-                # get channel names from the headers of the table
-                channel_names = line.decode('utf8').split()
-
-                # get rid of channel numbers in channel names
-                for channel_number, channel_name in enumerate(channel_names):
-                    result = re.search('(.*)\(.', channel_name)
-                    channel_names[channel_number] = result.group(1)
+        ecg_data, ecg_header = _get_ecg_channels(zip_file.filename, lambda: zip_file.read(ecg_filename),
+                                                 member=ecg_filename)
+        return (ecg_data, ecg_header) if header else ecg_data
+    raise NameError('File {} not found in zip archive!'.format(ecg_filename))
 
-                # get indexes of those channels we need to extract from data
-                # corresponding names defined in global Mapping_Channes
-                for mapping_channel_name in Mapping_Channels:
-                    channel_indexes.append(channel_names.index(mapping_channel_name))
 
-    return ecg_array.T
-
-
-def get_study_data(contact_files, ecg_files):
+def get_study_data(contact_files, ecg_files, dtype='float64'):
     """
     Directory version
     :param contact_files:
     :param ecg_files:
+    :param dtype: dtypes of the arrays, see DTYPE_POLICIES
     :return: two Numpy arrays 1) contact data with the shape = (#of contact points in zip, len(cols), 50) if start=150
                               2) ecg data with the shape = (#of ecg points in zip, len(Mapping_channels, 2500)
     """
-    cf_array = np.empty((len(contact_files), 3, 50), float)
-    ef_array = np.empty((len(ecg_files), 6, 2500), float)
+    cf_dtype, ecg_dtype = get_dtypes(dtype)
+    cf_array = np.empty((len(contact_files), 3, CF_WINDOW), cf_dtype)
+    ef_array = np.empty((len(ecg_files), 6, 2500), ecg_dtype)
     i = 0
 
     for cf, ef in zip(contact_files, ecg_files):
         print("reading " + cf)
         cf_array[i] = get_contact_data(cf)
-        ef_array[i] = get_ecg_data(ef)
+        ef_array[i] = _check_range(get_ecg_data(ef), ecg_dtype)
         i = i + 1
     return cf_array, ef_array
 
 
-def get_study_data_from_zip(zip_filename, cf_start=150, cf_cols=[3, 4, 5]):
+def get_study_data_from_zip(zip_filename, cf_start=150, cf_cols=[3, 4, 5], points=None, progress=True,
+                            metadata=False, dtype='float64', cf_time=None):
     """
     Zip version
     iterates through zip archive and calls 1) get_contact_data_from_zipped_txt() on all contact force files
@@ -356,59 +573,243 @@ def get_study_data_from_zip(zip_filename, cf_start=150, cf_cols=[3, 4, 5]):
     :param cf_start: positive time values start after index 150
     :param cf_cols: col0 = Index, col1 = relative time, col2 = timestamp, col3 = ForceValue, col4 = AxialAngle,
             col5 = LateralAngle, col6 = MetalSeverity, col7 = InAccurateSeverity, col8 = NeedZeroing
-    :return: two Numpy arrays 1) contact data with the shape = (#of contact points in zip, len(cols), 50) if start=150
+    :param points: optional slice of the points (in get_files_from_zip order) to read, all points by default
+    :param progress: show the progress bar
+    :param metadata: return also the metadata of the points
+    :param dtype: dtypes of the arrays, see DTYPE_POLICIES, a point with ecg values out of the range is skipped
+    :param cf_time: select the contact force by relative time in ms instead of cf_start, e.g. 0 for Time >= 0 ms
+    :return: two Numpy arrays 1) contact data with the shape = (#of contact points in zip, len(cols), 50)
                               2) ecg data with the shape = (#of ecg points in zip, len(Mapping_channels, 2500)
+             + array of METADATA_DTYPE if metadata=True
     """
 
     cf_files, ecg_files = get_files_from_zip(zip_filename)
     if len(cf_files) != len(ecg_files):
         raise NameError('Number of CF and ECG points not equal!')
-    cf_array = np.empty((0, len(cf_cols), CF_SAMPLES - cf_start), float)
-    ecg_array = np.empty((0, len(Mapping_Channels), ECG_SAMPLES), float)
+    if points is not None:
+        cf_files, ecg_files = cf_files[points], ecg_files[points]
+    # output buffers are allocated once for all points and filled in place
+    cf_dtype, ecg_dtype = get_dtypes(dtype)
+    cf_array = np.empty((len(cf_files), len(cf_cols), CF_WINDOW), cf_dtype)
+    ecg_array = np.empty((len(ecg_files), len(Mapping_Channels), ECG_SAMPLES), ecg_dtype)
+    meta_array = np.empty(len(cf_files) if metadata else 0, METADATA_DTYPE)
+    count = 0
 
     if is_zipfile(zip_filename):
         with ZipFile(zip_filename, 'r') as zip_file:
             with tqdm(total=len(cf_files), desc="Loading from {0}".format(os.path.basename(zip_filename)), ascii=False,
-                      ncols=150, colour='green', leave=True) as pbar:
+                      ncols=150, colour='green', leave=True, disable=not progress) as pbar:
                 for cf_file, ecg_file in zip(cf_files, ecg_files):
-                    new_cf_point = get_contact_data_from_zipped_txt(zip_file, cf_filename=cf_file, start=cf_start,
-                                                                    cols=cf_cols)
-                    cf_array = np.append(cf_array, [new_cf_point], axis=0)
                     pbar.update(1)
-
-                    new_ecg_point = get_ecg_data_from_zipped_txt(zip_file, ecg_filename=ecg_file)
-                    ecg_array = np.append(ecg_array, [new_ecg_point], axis=0)
+                    try:
+                        cf_array[count], cf_header = get_contact_data_from_zipped_txt(
+                            zip_file, cf_filename=cf_file, start=cf_start, cols=cf_cols, time=cf_time, header=True)
+                        ecg_data, ecg_header = get_ecg_data_from_zipped_txt(zip_file, ecg_filename=ecg_file,
+                                                                            header=True)
+                        ecg_array[count] = _check_range(ecg_data, ecg_dtype)
+                        if metadata:
+                            meta_array[count] = get_point_metadata(
+                                os.path.basename(cf_file).replace('_ContactForce.txt', ''), cf_header, zip_filename,
+                                ecg_header)
+                    except (ValueError, IndexError, AttributeError) as error:
+                        # the point is overwritten by the next one
+                        print("\nPoint {} skipped: {}".format(cf_file, error))
+                        continue
+                    count += 1
     else:
         print('File {} is corrupt!'.format(zip_filename))
+
+    # trimming the buffers in place if some points failed to parse, the memory is not copied
+    if count < len(cf_array):
+        for array in (cf_array, ecg_array, meta_array) if metadata else (cf_array, ecg_array):
+            array.resize((count,) + array.shape[1:], refcheck=False)
+    if metadata:
+        return cf_array, ecg_array, meta_array
     return cf_array, ecg_array
 
 
-def load_data(data_directory):
+def _sorted_by_map(cf_files, ecg_files):
+    """
+    reorders pairs of files so that the points of every map are consecutive, keeping the order inside a map
+    """
+    order = sorted(range(len(cf_files)), key=lambda i: point_map_name(os.path.basename(cf_files[i])))
+    return [cf_files[i] for i in order], [ecg_files[i] for i in order]
+
+
+def iter_study_points(source, cf_start=150, cf_cols=[3, 4, 5], sort_by_map=False, metadata=False, dtype=None,
+                      cf_time=None):
+    """
+    Directory and Zip version
+    generator over the points of a study, only one point is held in memory at a time
+    (the zip archive stays open while iterating)
+    points that fail to parse are skipped
+    :param source: zip archive name or name of directory with data files (unpacked zip archive)
+    :param cf_start: positive time values start after index 150
+    :param cf_cols: col0 = Index, col1 = relative time, col2 = timestamp, col3 = ForceValue, col4 = AxialAngle,
+            col5 = LateralAngle, col6 = MetalSeverity, col7 = InAccurateSeverity, col8 = NeedZeroing
+    :param sort_by_map: yield the points of every map consecutively
+    :param metadata: yield also the metadata of the point (row of METADATA_DTYPE)
+    :param dtype: dtypes of the arrays, see DTYPE_POLICIES, as parsed if None,
+            a point with ecg values out of the range is skipped
+    :param cf_time: select the contact force by relative time in ms instead of cf_start, e.g. 0 for Time >= 0 ms
+    :return: generator of (point_id, contact data with shape = (len(cols), 50),
+                           ecg data with shape = (len(Mapping_channels), 2500)[, metadata]),
+             point_id is the name of the file without _ContactForce.txt, e.g. '1-Map_P30'
+    """
+    def cast(cf_data, ecg_data):
+        if dtype is None:
+            return cf_data, ecg_data
+        cf_dtype, ecg_dtype = get_dtypes(dtype)
+        return cf_data.astype(cf_dtype), _check_range(ecg_data, ecg_dtype).astype(ecg_dtype)
+
+    if os.path.isdir(source):
+        cf_files, ecg_files = get_files(source)
+        if sort_by_map:
+            cf_files, ecg_files = _sorted_by_map(cf_files, ecg_files)
+        for cf_file, ecg_file in zip(cf_files, ecg_files):
+            point_id = os.path.basename(cf_file).replace('_ContactForce.txt', '')
+            try:
+                ecg_data, ecg_header = get_ecg_data(ecg_file, header=True)
+                cf_data, cf_header = get_contact_data(cf_file, start=cf_start, cols=cf_cols, time=cf_time, header=True)
+                point = (point_id,) + cast(cf_data, ecg_data)
+                if metadata:
+                    point += (get_point_metadata(point_id, cf_header, source, ecg_header),)
+            except (ValueError, IndexError, AttributeError) as error:
+                print("\nPoint {} skipped: {}".format(cf_file, error))
+                continue
+            yield point
+    elif is_zipfile(source):
+        cf_files, ecg_files = get_files_from_zip(source)
+        if sort_by_map:
+            cf_files, ecg_files = _sorted_by_map(cf_files, ecg_files)
+        with ZipFile(source, 'r') as zip_file:
+            for cf_file, ecg_file in zip(cf_files, ecg_files):
+                point_id = os.path.basename(cf_file).replace('_ContactForce.txt', '')
+                try:
+                    ecg_data, ecg_header = get_ecg_data_from_zipped_txt(zip_file, ecg_filename=ecg_file, header=True)
+                    cf_data, cf_header = get_contact_data_from_zipped_txt(zip_file, cf_filename=cf_file, start=cf_start,
+                                                                          cols=cf_cols, time=cf_time, header=True)
+                    point = (point_id,) + cast(cf_data, ecg_data)
+                    if metadata:
+                        point += (get_point_metadata(point_id, cf_header, source, ecg_header),)
+                except (ValueError, IndexError, AttributeError) as error:
+                    print("\nPoint {} skipped: {}".format(cf_file, error))
+                    continue
+                yield point
+    else:
+        print('File {} is corrupt!'.format(source))
+
+
+def iter_study_batches(source, batch_size=100, cf_start=150, cf_cols=[3, 4, 5], sort_by_map=False, metadata=False,
+                       dtype='float64', cf_time=None):
+    """
+    Directory and Zip version
+    batched variant of iter_study_points(), memory is bounded by batch_size points
+    :param source: zip archive name or name of directory with data files (unpacked zip archive)
+    :param batch_size: number of points per batch (the last batch can be smaller)
+    :param cf_start: positive time values start after index 150
+    :param cf_cols: see iter_study_points()
+    :param sort_by_map: yield the points of every map consecutively
+    :param metadata: yield also the metadata of the points (array of METADATA_DTYPE)
+    :param dtype: dtypes of the arrays, see DTYPE_POLICIES
+    :param cf_time: see iter_study_points()
+    :return: generator of (list of point_ids, contact data with shape = (batch_size, len(cols), 50),
+                           ecg data with shape = (batch_size, len(Mapping_channels), 2500)[, metadata])
+    """
+    point_ids = []
+    cf_dtype, ecg_dtype = get_dtypes(dtype)
+    cf_array = np.empty((batch_size, len(cf_cols), CF_WINDOW), cf_dtype)
+    ecg_array = np.empty((batch_size, len(Mapping_Channels), ECG_SAMPLES), ecg_dtype)
+    meta_array = np.empty(batch_size, METADATA_DTYPE)
+    for point in iter_study_points(source, cf_start=cf_start, cf_cols=cf_cols, sort_by_map=sort_by_map,
+                                   metadata=metadata, dtype=dtype, cf_time=cf_time):
+        cf_array[len(point_ids)] = point[1]
+        ecg_array[len(point_ids)] = point[2]
+        if metadata:
+            meta_array[len(point_ids)] = point[3]
+        point_ids.append(point[0])
+        if len(point_ids) == batch_size:
+            yield (point_ids, cf_array, ecg_array) + ((meta_array,) if metadata else ())
+            # new buffers, the yielded ones belong to the caller
+            point_ids = []
+            cf_array = np.empty_like(cf_array)
+            ecg_array = np.empty_like(ecg_array)
+            meta_array = np.empty_like(meta_array)
+    if point_ids:
+        count = len(point_ids)
+        yield (point_ids, cf_array[:count], ecg_array[:count]) + ((meta_array[:count],) if metadata else ())
+
+
+def get_npy_pairs(data_directory):
+    """
+    searches data_directory for the pairs of _cf_data.npy and _ecg_data.npy files
+    :param data_directory: name of directory with data
+    :return: list of (cf_npy, ecg_npy) filenames
+    """
+    npy_files = glob.glob(data_directory + '/*.npy')
+    pairs = []
+    for npy in npy_files:
+        if re.search('_cf_data.npy', npy):
+            ecg_npy = npy.replace('_cf_data.npy', '_ecg_data.npy')
+            if ecg_npy in npy_files:
+                pairs.append((npy, ecg_npy))
+    return pairs
+
+
+def _get_saved_dtypes(pairs):
+    # (cf dtype, ecg dtype) that holds the data of all pairs of memory-mapped .npy files
+    if not pairs:
+        return get_dtypes()
+    return np.result_type(*[cf for cf, _ in pairs]), np.result_type(*[ecg for _, ecg in pairs])
+
+
+def load_data(data_directory, dtype=None):
     """
     loads contact force and ecg data from .npy files in data_directory
+    the files are memory-mapped and copied once into preallocated arrays
     :param data_directory: name of directory with data
+    :param dtype: dtypes of the arrays, see DTYPE_POLICIES, the dtypes of the saved files if None
     :return: two Numpy arrays 1) contact data with the shape = (#of contact points in zip, len(cols), 50) if start=150
                               2) ecg data with the shape = (#of ecg points in zip, len(Mapping_channels, 2500)
     """
-    npy_files = glob.glob(data_directory + '/*.npy')
-    cf_array = np.empty((0, 3, CF_SAMPLES - 150), float)
-    ecg_array = np.empty((0, len(Mapping_Channels), ECG_SAMPLES), float)
-    with tqdm(total=len(npy_files), desc="Loading ...", ascii=False,
+    pairs = [(np.load(cf_npy, mmap_mode='r'), np.load(ecg_npy, mmap_mode='r'))
+             for cf_npy, ecg_npy in get_npy_pairs(data_directory)]
+    cf_dtype, ecg_dtype = _get_saved_dtypes(pairs) if dtype is None else get_dtypes(dtype)
+    cf_array = np.empty((sum(len(cf) for cf, _ in pairs), 3, CF_WINDOW), cf_dtype)
+    ecg_array = np.empty((sum(len(ecg) for _, ecg in pairs), len(Mapping_Channels), ECG_SAMPLES), ecg_dtype)
+    cf_count = 0
+    ecg_count = 0
+    with tqdm(total=len(pairs), desc="Loading ...", ascii=False,
               ncols=150, colour='yellow', leave=True) as pbar:
-        for npy in npy_files:
+        for cf_import, ecg_import in pairs:
             pbar.update(1)
-            cf = re.search('_cf_data.npy', npy)
-            if cf:
-                ecg_npy = npy.replace('_cf_data.npy', '_ecg_data.npy')
-                if ecg_npy in npy_files:
-                    cf_import = np.load(npy)
-                    ecg_import = np.load(ecg_npy)
-                    cf_array = np.append(cf_array, cf_import, axis=0)
-                    ecg_array = np.append(ecg_array, ecg_import, axis=0)
+            cf_array[cf_count:cf_count + len(cf_import)] = cf_import
+            ecg_array[ecg_count:ecg_count + len(ecg_import)] = _check_range(ecg_import, ecg_dtype)
+            cf_count += len(cf_import)
+            ecg_count += len(ecg_import)
 
     return cf_array, ecg_array
 
 
+def load_metadata(data_directory):
+    """
+    loads the metadata of the points from _meta.npy files in data_directory,
+    the rows correspond to the rows of the arrays returned by load_data()
+    :param data_directory: name of directory with data
+    :return: Numpy array of METADATA_DTYPE with the shape = (#of points,)
+    """
+    meta_arrays = []
+    for cf_npy, _ in get_npy_pairs(data_directory):
+        meta_npy = cf_npy.replace('_cf_data.npy', '_meta.npy')
+        if os.path.exists(meta_npy):
+            meta_arrays.append(np.load(meta_npy))
+        else:
+            # empty rows keep the metadata aligned with the data
+            print('No metadata for {}'.format(cf_npy))
+            meta_arrays.append(empty_metadata(len(np.load(cf_npy, mmap_mode='r'))))
+    return np.concatenate(meta_arrays) if meta_arrays else np.empty(0, METADATA_DTYPE)
+
+
 def ask_directory():
     root = Tk()
     root.withdraw()
@@ -457,23 +858,275 @@ def plot_all_points(data, titles=None):
         graph.canvas.draw()
 
 
-def zip_to_npy(data_directory):
-    zipfiles = get_zip_files_paths(data_directory)
+def _get_study_chunk_from_zip(zip_filename, start, stop, dtype='float64'):
+    """
+    process pool worker of zip_to_npy: reads points [start, stop) of the zip archive without progress bar
+    :return: zip archive name, start, contact data, ecg data, metadata
+    """
+    cf_data, ecg_data, meta_data = get_study_data_from_zip(zip_filename, points=slice(start, stop), progress=False,
+                                                           metadata=True, dtype=dtype)
+    return zip_filename, start, cf_data, ecg_data, meta_data
+
+
+def _run_chunk_tasks(tasks, workers=1, desc="Loading ...", dtype='float64'):
+    """
+    runs _get_study_chunk_from_zip for every task, serially if workers == 1, otherwise in a process pool
+    the progress of all tasks is shown as one progress bar
+    :param tasks: list of (zip archive name, start, stop)
+    :param workers: number of processes (None = number of CPUs)
+    :param desc: description of the progress bar
+    :param dtype: dtypes of the arrays, see DTYPE_POLICIES
+    :return: generator of the results of _get_study_chunk_from_zip in order of completion
+    """
+    with tqdm(total=sum(stop - start for _, start, stop in tasks), desc=desc, ascii=False,
+              ncols=150, colour='green', leave=True) as pbar:
+        if workers == 1:
+            for zipfile, start, stop in tasks:
+                yield _get_study_chunk_from_zip(zipfile, start, stop, dtype)
+                pbar.update(stop - start)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(_get_study_chunk_from_zip, *task, dtype): task for task in tasks}
+                for future in as_completed(futures):
+                    _, start, stop = futures[future]
+                    pbar.update(stop - start)
+                    yield future.result()
+
+
+def _split_into_tasks(zip_filename, points, points_per_task=None):
+    # (zip archive name, start, stop) for every points_per_task points, one task for an empty archive
+    step = points_per_task or max(points, 1)
+    return [(zip_filename, start, min(start + step, points)) for start in range(0, max(points, 1), step)]
+
+
+def get_study_data_from_zips(zipfiles, workers=None, points_per_task=None, dtype='float64'):
+    """
+    reads several zip archives in a process pool, archives are independent so every archive
+    (or every points_per_task points of an archive) is a separate task
+    the progress of all workers is shown as one progress bar in the parent process
+    :param zipfiles: list of zip archive names
+    :param workers: number of processes, defaults to the number of CPUs
+    :param points_per_task: split archives into tasks of this number of points, whole archive per task if None
+    :param dtype: dtypes of the arrays, see DTYPE_POLICIES
+    :return: generator of (zip archive name, contact data, ecg data, metadata) in order of completion
+    """
+    tasks = {zipfile: _split_into_tasks(zipfile, len(get_files_from_zip(zipfile)[0]), points_per_task)
+             for zipfile in zipfiles}
+    chunks = {zipfile: {} for zipfile in zipfiles}
+    for zipfile, start, cf_data, ecg_data, meta_data in _run_chunk_tasks(
+            [task for archive_tasks in tasks.values() for task in archive_tasks], workers=workers,
+            desc="Loading from {0} files".format(len(zipfiles)), dtype=dtype):
+        chunks[zipfile][start] = cf_data, ecg_data, meta_data
+        # the archive is ready when all its chunks are loaded
+        if len(chunks[zipfile]) == len(tasks[zipfile]):
+            ordered = [chunks[zipfile][start] for start in sorted(chunks[zipfile])]
+            del chunks[zipfile]
+            yield (zipfile, np.concatenate([chunk[0] for chunk in ordered]),
+                   np.concatenate([chunk[1] for chunk in ordered]),
+                   np.concatenate([chunk[2] for chunk in ordered]))
+
+
+def save_json(filename, data):
+    """
+    writes data as JSON, the file is replaced atomically so a crash never leaves a half-written file
+    """
+    with open(filename + '.tmp', 'w') as file:
+        json.dump(data, file, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def get_archive_signature(zip_filename, hash_content=False):
+    """
+    :param zip_filename: zip archive name
+    :param hash_content: add sha1 of the content (reads the whole file)
+    :return: dictionary with size, mtime and optionally sha1 of the archive
+    """
+    stat = os.stat(zip_filename)
+    signature = {"size": stat.st_size, "mtime": stat.st_mtime}
+    if hash_content:
+        sha1 = hashlib.sha1()
+        with open(zip_filename, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                sha1.update(block)
+        signature["sha1"] = sha1.hexdigest()
+    return signature
+
+
+def _is_unchanged(zip_filename, old_signature, hash_content=False):
+    # size and mtime are compared first, the content is hashed only if the archive was touched
+    signature = get_archive_signature(zip_filename)
+    if signature["size"] != old_signature["size"]:
+        return False
+    if signature["mtime"] == old_signature["mtime"]:
+        return True
+    if hash_content and "sha1" in old_signature:
+        if get_archive_signature(zip_filename, hash_content=True)["sha1"] == old_signature["sha1"]:
+            old_signature["mtime"] = signature["mtime"]
+            return True
+    return False
+
+
+def load_manifest(data_directory):
+    """
+    loads the manifest of the incremental zip_to_npy
+    :param data_directory: directory with .npy files
+    :return: {"archives": {absolute zip archive name: {"signature": ..., "number": number in output names,
+                                                       "points": ..., "chunk_size": ..., "chunks": {start: part file},
+                                                       "outputs": [.npy files], "complete": bool}}}
+    """
+    manifest_filename = os.path.join(data_directory, MANIFEST_FILE)
+    if not os.path.exists(manifest_filename):
+        return {"archives": {}}
+    with open(manifest_filename, 'r') as file:
+        return json.load(file)
+
+
+def _save_npy_outputs(data_directory, zipfile, number, cf_data, ecg_data, meta_data):
+    # saves the arrays of one zip archive, returns the names of the files
+    cf_filename = os.path.join(data_directory, os.path.basename(
+        zipfile.replace('.zip', '_' + str(number) + '_cf_data.npy')))
+    ecg_filename = os.path.join(data_directory, os.path.basename(
+        zipfile.replace('.zip', '_' + str(number) + '_ecg_data.npy')))
+    meta_filename = cf_filename.replace('_cf_data.npy', '_meta.npy')
+    np.save(cf_filename, cf_data)
+    np.save(ecg_filename, ecg_data)
+    np.save(meta_filename, meta_data)
+    return [cf_filename, ecg_filename, meta_filename]
+
+
+def _finish_archive(data_directory, zipfile, entry, manifest_filename, manifest):
+    # concatenates the saved chunks of the archive into the output files and removes the chunks,
+    # the manifest is saved before, so it never refers to removed chunks
+    parts = [entry["chunks"][start] for start in sorted(entry["chunks"], key=int)]
+    loaded = []
+    for part in parts:
+        with np.load(part) as npz:
+            loaded.append((npz['cf_data'], npz['ecg_data'], npz['meta_data']))
+    meta_data = np.concatenate([chunk[2] for chunk in loaded])
+    entry["outputs"] = _save_npy_outputs(data_directory, zipfile, entry["number"],
+                                         np.concatenate([chunk[0] for chunk in loaded]),
+                                         np.concatenate([chunk[1] for chunk in loaded]), meta_data)
+    entry["chunks"] = {}
+    entry["complete"] = True
+    save_json(manifest_filename, manifest)
+    for part in parts:
+        os.remove(part)
+    return len(meta_data)
+
+
+def _update_npy(data_directory, zipfiles, workers=1, checkpoint=None, hash_content=False, dtype='float64'):
+    """
+    incremental version of zip_to_npy, the state is kept in the manifest file in data_directory
+    unchanged archives are skipped, changed archives are processed again
+    every archive is read in chunks of checkpoint points, every chunk is saved into data_directory/.partial
+    as soon as it is loaded, so an interrupted run continues from the last saved chunk
+    :return: number of processed archives, number of points in them
+    """
+    manifest = load_manifest(data_directory)
+    archives = manifest["archives"]
+    manifest_filename = os.path.join(data_directory, MANIFEST_FILE)
+    partial_dir = os.path.join(data_directory, '.partial')
+    os.makedirs(partial_dir, exist_ok=True)
+    used_numbers = {entry["number"] for entry in archives.values()}
+    dtypes = [dtype.str for dtype in get_dtypes(dtype)]
+
+    tasks = []
+    entries = {}
+    for position, zipfile in enumerate(zipfiles, start=1):
+        entry = archives.get(os.path.abspath(zipfile))
+        changed = entry and not _is_unchanged(zipfile, entry["signature"], hash_content)
+        if changed:
+            print('Archive {} has changed, processing again'.format(zipfile))
+        elif entry and entry["dtypes"] != dtypes:
+            changed = True
+            print('Archive {} was saved with other dtypes, processing again'.format(zipfile))
+        if changed:
+            for part in entry["chunks"].values():
+                if os.path.exists(part):
+                    os.remove(part)
+            entry = dict(entry, chunks={}, complete=False, points=len(get_files_from_zip(zipfile)[0]),
+                         chunk_size=checkpoint, signature=get_archive_signature(zipfile, hash_content),
+                         dtypes=dtypes)
+        elif entry and entry["complete"] and all(os.path.exists(output) for output in entry["outputs"]):
+            print('Archive {} is unchanged, skipped'.format(zipfile))
+            continue
+        elif entry is None:
+            # archives are numbered in the order of zipfiles as in zip_to_npy, if the number is free
+            number = position if position not in used_numbers else max(used_numbers) + 1
+            used_numbers.add(number)
+            entry = {"signature": get_archive_signature(zipfile, hash_content), "number": number,
+                     "points": len(get_files_from_zip(zipfile)[0]), "chunk_size": checkpoint, "chunks": {},
+                     "outputs": [], "complete": False, "dtypes": dtypes}
+        entry["complete"] = False
+        archives[os.path.abspath(zipfile)] = entries[zipfile] = entry
+        tasks += [task for task in _split_into_tasks(zipfile, entry["points"], entry["chunk_size"])
+                  if str(task[1]) not in entry["chunks"]]
+    save_json(manifest_filename, manifest)
+
+    points_count = 0
+    chunks_count = {zipfile: len(_split_into_tasks(zipfile, entry["points"], entry["chunk_size"]))
+                    for zipfile, entry in entries.items()}
+    for zipfile, entry in entries.items():
+        # all chunks were saved before the interruption
+        if len(entry["chunks"]) == chunks_count[zipfile]:
+            points_count += _finish_archive(data_directory, zipfile, entry, manifest_filename, manifest)
+    save_json(manifest_filename, manifest)
+
+    for zipfile, start, cf_data, ecg_data, meta_data in _run_chunk_tasks(
+            tasks, workers=workers, desc="Loading from {0} files".format(len(entries)), dtype=dtype):
+        entry = entries[zipfile]
+        part = os.path.join(partial_dir, '{}_{}_{}.npz'.format(
+            os.path.basename(zipfile).replace('.zip', ''), entry["number"], start))
+        np.savez(part, cf_data=cf_data, ecg_data=ecg_data, meta_data=meta_data)
+        entry["chunks"][str(start)] = part
+        if len(entry["chunks"]) == chunks_count[zipfile]:
+            points_count += _finish_archive(data_directory, zipfile, entry, manifest_filename, manifest)
+        save_json(manifest_filename, manifest)
+    return len(entries), points_count
+
+
+def zip_to_npy(data_directory, workers=1, points_per_task=None, zipfiles=None, incremental=False,
+               hash_content=False, dtype='float64'):
+    """
+    converts every zip archive in data_directory into a pair of _cf_data.npy and _ecg_data.npy files
+    and the _meta.npy file with the metadata of the points (see METADATA_DTYPE)
+    :param data_directory: directory with zip archives, .npy files are saved there
+    :param workers: number of processes, archives are processed in a process pool if workers != 1
+            (None = number of CPUs)
+    :param points_per_task: with workers != 1 splits large archives into tasks of this number of points,
+            with incremental=True the number of points between checkpoints (CHECKPOINT_POINTS by default)
+    :param zipfiles: list of zip archives to convert instead of the archives in data_directory, e.g. from get_paths()
+    :param incremental: skip the archives converted by a previous run if they are unchanged (size, mtime)
+            and continue interrupted conversions, the state is kept in data_directory/manifest.json
+    :param hash_content: with incremental=True compare also sha1 of the content, so touched but unchanged
+            archives are skipped
+    :param dtype: dtypes of the saved arrays, see DTYPE_POLICIES ('compact' = float32 contact force, int16 ecg,
+            the gain for ecg_to_mv() is saved in _meta.npy)
+    """
+    if zipfiles is None:
+        zipfiles = get_zip_files_paths(data_directory)
     print('In ', data_directory, ' found ', len(zipfiles), ' .zip archives: ')
     for zipfile in zipfiles:
         print(os.path.basename(zipfile))
-    zipfile_count = 0
-    points_count = 0
-    for zipfile in zipfiles:
-        zipfile_count += 1
-        cf_data, ecg_data = get_study_data_from_zip(zipfile)
-        points_count += len(cf_data)
-        cf_filename = os.path.join(data_directory, os.path.basename(
-            zipfile.replace('.zip', '_' + str(zipfile_count) + '_cf_data.npy')))
-        ecg_filename = os.path.join(data_directory, os.path.basename(
-            zipfile.replace('.zip', '_' + str(zipfile_count) + '_ecg_data.npy')))
-        np.save(cf_filename, cf_data)
-        np.save(ecg_filename, ecg_data)
+    if incremental:
+        zipfile_count, points_count = _update_npy(data_directory, zipfiles, workers=workers,
+                                                  checkpoint=points_per_task or CHECKPOINT_POINTS,
+                                                  hash_content=hash_content, dtype=dtype)
+    else:
+        # output names are numbered in the order of get_zip_files_paths as in the serial run
+        zipfile_numbers = {zipfile: number for number, zipfile in enumerate(zipfiles, start=1)}
+        if workers == 1:
+            study_data = ((zipfile, *get_study_data_from_zip(zipfile, metadata=True, dtype=dtype))
+                          for zipfile in zipfiles)
+        else:
+            study_data = get_study_data_from_zips(zipfiles, workers=workers, points_per_task=points_per_task,
+                                                  dtype=dtype)
+        zipfile_count = 0
+        points_count = 0
+        for zipfile, cf_data, ecg_data, meta_data in study_data:
+            zipfile_count += 1
+            points_count += len(cf_data)
+            _save_npy_outputs(data_directory, zipfile, zipfile_numbers[zipfile], cf_data, ecg_data, meta_data)
 
     print('Data processed from ', zipfile_count, ' files')
     print('Number of points: ', points_count)
@@ -484,18 +1137,36 @@ def zip_to_npy(data_directory):
 def merge_npy(data_directory, filename_prefix='total'):
     """
     merges all npy files in two files
+    the merged files are preallocated on disk and filled pair by pair, so only one pair is held in memory
+    the dtypes of the saved files are kept
     :param data_directory: where all npy files are located
     :param filename_prefix: prefix for name of new files
     :return: number of points, final names of the files
     """
-    cf_data, ecg_data = load_data(data_directory)
-    cf_count = len(cf_data)
-    ecg_count = len(ecg_data)
-    cf_npy = os.path.join(data_directory, filename_prefix + cf_count + '_cf_data.npy')
-    ecg_npy = os.path.join(data_directory, filename_prefix + ecg_count + '_ecg_data.npy')
-
-    np.save(cf_npy, cf_data)
-    np.save(ecg_npy, ecg_data)
+    pairs = [(np.load(cf_npy, mmap_mode='r'), np.load(ecg_npy, mmap_mode='r'))
+             for cf_npy, ecg_npy in get_npy_pairs(data_directory)]
+    cf_count = sum(len(cf) for cf, _ in pairs)
+    ecg_count = sum(len(ecg) for _, ecg in pairs)
+    cf_npy = os.path.join(data_directory, filename_prefix + str(cf_count) + '_cf_data.npy')
+    ecg_npy = os.path.join(data_directory, filename_prefix + str(ecg_count) + '_ecg_data.npy')
+    meta_data = load_metadata(data_directory)
+    cf_dtype, ecg_dtype = _get_saved_dtypes(pairs)
+
+    cf_data = np.lib.format.open_memmap(cf_npy, mode='w+', dtype=cf_dtype,
+                                        shape=(cf_count, 3, CF_WINDOW))
+    ecg_data = np.lib.format.open_memmap(ecg_npy, mode='w+', dtype=ecg_dtype,
+                                         shape=(ecg_count, len(Mapping_Channels), ECG_SAMPLES))
+    cf_start = 0
+    ecg_start = 0
+    for cf_import, ecg_import in pairs:
+        cf_data[cf_start:cf_start + len(cf_import)] = cf_import
+        ecg_data[ecg_start:ecg_start + len(ecg_import)] = ecg_import
+        cf_start += len(cf_import)
+        ecg_start += len(ecg_import)
+    cf_data.flush()
+    ecg_data.flush()
+    del cf_data, ecg_data
+    np.save(cf_npy.replace('_cf_data.npy', '_meta.npy'), meta_data)
     print("Contact force values for {0} points are saved into {1}".format(cf_count, cf_npy))
     print("Electrogramms for {0} points are saved into {1}".format(ecg_count, ecg_npy))
 
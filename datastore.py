@@ -0,0 +1,227 @@
+import json
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+import cartoutils
+
+INDEX_FILE = 'index.json'
+CF_FILE = 'cf_data.bin'
+ECG_FILE = 'ecg_data.bin'
+META_FILE = 'meta_data.bin'
+POINTS_FILE = 'point_ids.bin'
+POINT_ID_DTYPE = np.dtype('U64')  # point_id of every row, e.g. '1-Map_P30'
+
+
+def load_index(store_dir):
+    """
+    loads the JSON index of the store
+    :param store_dir: directory of the store
+    :return: index dictionary (empty index if the store does not exist yet)
+    """
+    index_filename = os.path.join(store_dir, INDEX_FILE)
+    if not os.path.exists(index_filename):
+        return {
+            "count": 0,            # number of points in the store
+            "cf_dtype": None,      # dtype and shape of one point, set by the first append
+            "cf_shape": None,
+            "ecg_dtype": None,
+            "ecg_shape": None,
+            # study name -> {"source": zip archive, "ranges": [[start, stop]], "maps": {map name: [[start, stop]]}}
+            "studies": {},
+        }
+    with open(index_filename, 'r') as file:
+        return json.load(file)
+
+
+def _save_index(store_dir, index):
+    # the index is replaced atomically, so a crash during append leaves the previous version
+    cartoutils.save_json(os.path.join(store_dir, INDEX_FILE), index)
+
+
+def _add_range(ranges, start, stop):
+    # extends the last range if the new rows follow it
+    if ranges and ranges[-1][1] == start:
+        ranges[-1][1] = stop
+    else:
+        ranges.append([start, stop])
+
+
+def append_rows(filename, data, count):
+    """
+    appends rows to a raw binary file, the rows written after the first count rows (e.g. by an interrupted append
+    before its index was saved) are dropped first, used by the store, egm_index and egm_features
+    :param filename: raw binary file, created if not exists
+    :param data: Numpy array of the new rows
+    :param count: number of valid rows in the file (from the index saved with the file)
+    """
+    if len(data) == 0:
+        return
+    row_size = data.nbytes // len(data)
+    with open(filename, 'r+b' if os.path.exists(filename) else 'wb') as file:
+        file.truncate(count * row_size)
+        file.seek(count * row_size)
+        data.tofile(file)
+
+
+def append_to_store(store_dir, cf_data, ecg_data, point_ids, study, source=None, metadata=None):
+    """
+    appends points to the store without rewriting it: the arrays and the point ids are appended to the raw binary
+    files and the JSON index (ranges of the studies and maps) is updated
+    :param store_dir: directory of the store, created if not exists
+    :param cf_data: contact data with the shape = (#of points, len(cols), 50)
+    :param ecg_data: ecg data with the shape = (#of points, len(Mapping_channels), 2500)
+    :param point_ids: point_id of every point, e.g. '1-Map_P30'
+    :param study: name of the study the points belong to
+    :param source: name of the zip archive the points were read from
+    :param metadata: metadata of the points (array of cartoutils.METADATA_DTYPE), empty rows if None
+    :return: updated index
+    """
+    if not (len(cf_data) == len(ecg_data) == len(point_ids)):
+        raise NameError('Number of CF and ECG points not equal!')
+    os.makedirs(store_dir, exist_ok=True)
+    index = load_index(store_dir)
+    if index["cf_dtype"] is None:
+        index["cf_dtype"], index["cf_shape"] = np.dtype(cf_data.dtype).str, list(cf_data.shape[1:])
+        index["ecg_dtype"], index["ecg_shape"] = np.dtype(ecg_data.dtype).str, list(ecg_data.shape[1:])
+    if list(cf_data.shape[1:]) != index["cf_shape"] or list(ecg_data.shape[1:]) != index["ecg_shape"]:
+        raise ValueError('Shape of the points {}, {} does not match the store {}, {}'.format(
+            cf_data.shape[1:], ecg_data.shape[1:], index["cf_shape"], index["ecg_shape"]))
+
+    start = index["count"]
+    append_rows(os.path.join(store_dir, CF_FILE),
+                np.ascontiguousarray(cf_data, dtype=index["cf_dtype"]), start)
+    append_rows(os.path.join(store_dir, ECG_FILE),
+                np.ascontiguousarray(ecg_data, dtype=index["ecg_dtype"]), start)
+    if metadata is None:
+        metadata = cartoutils.empty_metadata(len(point_ids))
+    append_rows(os.path.join(store_dir, META_FILE),
+                np.ascontiguousarray(metadata, dtype=cartoutils.METADATA_DTYPE), start)
+
+    append_rows(os.path.join(store_dir, POINTS_FILE), np.array(point_ids, POINT_ID_DTYPE), start)
+
+    study_entry = index["studies"].setdefault(study, {"source": source, "ranges": [], "maps": {}})
+    _add_range(study_entry["ranges"], start, start + len(point_ids))
+    for i, point_id in enumerate(point_ids):
+        _add_range(study_entry["maps"].setdefault(cartoutils.point_map_name(point_id), []),
+                   start + i, start + i + 1)
+    index["count"] = start + len(point_ids)
+    _save_index(store_dir, index)
+    return index
+
+
+def zip_to_store(zip_filename, store_dir, batch_size=100, dtype='float64'):
+    """
+    reads a zip archive in batches and appends it to the store, the points of every map are stored consecutively
+    :param zip_filename: zip archive name
+    :param store_dir: directory of the store
+    :param batch_size: number of points held in memory
+    :param dtype: dtypes of the arrays, see cartoutils.DTYPE_POLICIES, the first study sets the dtypes of the store
+    :return: number of points appended (0 if the study is already in the store)
+    """
+    study = os.path.basename(zip_filename).replace('.zip', '')
+    if study in load_index(store_dir)["studies"]:
+        print('Study {} is already in the store, skipped'.format(study))
+        return 0
+    points_count = 0
+    with tqdm(desc="Appending {0}".format(os.path.basename(zip_filename)), ascii=False,
+              ncols=150, colour='green', leave=True) as pbar:
+        for point_ids, cf_data, ecg_data, meta_data in cartoutils.iter_study_batches(
+                zip_filename, batch_size=batch_size, sort_by_map=True, metadata=True, dtype=dtype):
+            append_to_store(store_dir, cf_data, ecg_data, point_ids, study, source=zip_filename,
+                            metadata=meta_data)
+            points_count += len(point_ids)
+            pbar.update(len(point_ids))
+    return points_count
+
+
+def open_store(store_dir, mode='r'):
+    """
+    opens the store memory-mapped, slicing the returned arrays does not copy the data
+    :param store_dir: directory of the store
+    :param mode: 'r' read only, 'r+' to modify the points in place
+    :return: two memory-mapped Numpy arrays 1) contact data with the shape = (#of points, len(cols), 50)
+                                            2) ecg data with the shape = (#of points, len(Mapping_channels), 2500)
+             and the index
+    """
+    index = load_index(store_dir)
+    arrays = []
+    for filename, dtype, shape in ((CF_FILE, index["cf_dtype"], index["cf_shape"]),
+                                   (ECG_FILE, index["ecg_dtype"], index["ecg_shape"])):
+        if index["count"] == 0:
+            arrays.append(np.empty((0,) + tuple(shape or ()), dtype or float))
+        else:
+            arrays.append(np.memmap(os.path.join(store_dir, filename), dtype=dtype, mode=mode,
+                                    shape=(index["count"],) + tuple(shape)))
+    return arrays[0], arrays[1], index
+
+
+def open_metadata(store_dir):
+    """
+    opens the metadata of the store memory-mapped, the rows correspond to the rows of open_store() arrays
+    filter with cartoutils.select_points(), lookup with cartoutils.get_point_lookup()
+    :param store_dir: directory of the store
+    :return: memory-mapped Numpy array of cartoutils.METADATA_DTYPE
+    """
+    index = load_index(store_dir)
+    if index["count"] == 0:
+        return np.empty(0, cartoutils.METADATA_DTYPE)
+    return np.memmap(os.path.join(store_dir, META_FILE), dtype=cartoutils.METADATA_DTYPE, mode='r',
+                     shape=(index["count"],))
+
+
+def get_slices(index, study=None, map_name=None):
+    """
+    finds the rows of a study, of a map (in all studies) or of a map in a study
+    :param index: index of the store
+    :param study: name of the study
+    :param map_name: name of the map, e.g. '1-Map'
+    :return: list of slices, data[s] for every slice is a view into the memory-mapped store
+    """
+    studies = [index["studies"][study]] if study is not None else index["studies"].values()
+    ranges = []
+    for study_entry in studies:
+        if map_name is None:
+            ranges += study_entry["ranges"]
+        else:
+            ranges += study_entry["maps"].get(map_name, [])
+    return [slice(start, stop) for start, stop in ranges]
+
+
+def open_point_ids(store_dir):
+    """
+    opens the point ids of the store memory-mapped, the rows correspond to the rows of open_store() arrays
+    :param store_dir: directory of the store
+    :return: memory-mapped Numpy array of POINT_ID_DTYPE, e.g. '1-Map_P30'
+    """
+    index = load_index(store_dir)
+    if index["count"] == 0:
+        return np.empty(0, POINT_ID_DTYPE)
+    return np.memmap(os.path.join(store_dir, POINTS_FILE), dtype=POINT_ID_DTYPE, mode='r', shape=(index["count"],))
+
+
+def get_point_index(store_dir, point_id, study=None):
+    """
+    only the rows of the map of the point are compared
+    :param store_dir: directory of the store
+    :param point_id: e.g. '1-Map_P30'
+    :param study: name of the study, point_ids are unique only inside a study
+    :return: row of the point in the store
+    """
+    index = load_index(store_dir)
+    point_ids = open_point_ids(store_dir)
+    for data_slice in get_slices(index, study=study, map_name=cartoutils.point_map_name(point_id)):
+        rows = np.flatnonzero(point_ids[data_slice] == point_id)
+        if len(rows):
+            return data_slice.start + int(rows[0])
+    raise KeyError('Point {} not found in the store'.format(point_id))
+
+
+def select(data, slices):
+    """
+    :param data: memory-mapped array from open_store()
+    :param slices: slices from get_slices()
+    :return: list of views into data
+    """
+    return [data[data_slice] for data_slice in slices]
@@ -1,4 +1,7 @@
+import itertools
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from matplotlib.lines import Line2D
 import matplotlib.patches as patches
 from PIL import Image
@@ -6,37 +9,32 @@ import numpy as np
 import re
 
 
+# indexes of the leads in the table by (line of the column names, lead names), the files of a study share the header
+_lead_indices = {}
+
+
+# resolves the lead names to column indexes once per header, returns the indexes and the number of columns
+def get_lead_indices(header_line, leads):
+    key = header_line, leads
+    if key not in _lead_indices:
+        channel_names = [re.search(r'(.*)\(.', c).group(1) for c in header_line.split()]
+        _lead_indices[key] = [channel_names.index(lead) for lead in leads], len(channel_names)
+    return _lead_indices[key]
+
+
+# gets the leads from the text of an ecg file: the whole table is read at once and the columns are selected
+def read_leads(text, ders):
+    lines = text.split('\n', 4)
+    leads = ders if type(ders) == tuple else (ders,)  # a single lead gives a table of one row as well
+    indices, columns = get_lead_indices(lines[3], leads)
+    table = np.fromstring(lines[4] if len(lines) > 4 else '', dtype=int, sep=' ').reshape(-1, columns)
+    return np.transpose(table[:, indices])
+
+
 # gets 12 lead data from file given channel names
 def get_ecg_data(filename, ders):
-    file = open(filename, 'r')
-    lines = file.readlines()
-    derivations = {}  # make and populate a dictionary out of a tuple
-    if type(ders) == tuple:
-        for i, der in enumerate(ders):
-            derivations["d" + str(i)] = der
-        channels = np.empty((0, len(derivations)), int)
-    elif type(ders) == str:  # if a single lead was passed
-        derivations["d0"] = ders
-        channels = np.empty((0, 1), int)
-    indices = {}
-    read_data = False
-    for i, line in enumerate(lines):
-        if read_data:  # get the data at indices
-            newline = np.fromstring(line, dtype=int, sep=' ')
-            channel_array = []
-            for key in derivations:
-                channel_array.append(newline[indices["%s_index" % key]])
-            channels = np.append(channels, [channel_array], axis=0)
-        if i == 3:  # find columns with specified leads and save their index
-            read_data = True
-            channel_names = line.split()
-            for j, c in enumerate(channel_names):
-                result = re.search('(.*)\(.', c)
-                channel_names[j] = result.group(1)
-            for k, d in enumerate(derivations):
-                indices["d%s_index" % k] = channel_names.index(derivations["d" + str(k)])
-
-    return np.transpose(channels), ders  # return ecg data and lead names
+    with open(filename, 'r') as file:
+        return read_leads(file.read(), ders), ders  # return ecg data and lead names
 
 
 # adds 7,5 seconds of invisible line or multiplies data
@@ -54,10 +52,15 @@ def make_longer(array, multiply):
     return new, array[1]
 
 
-# annotations
-def draw_on_ecg(figure, speed):
-    canvas = figure.add_subplot()
+# bottom annotation line
+def get_annotation(speed):
+    return "GE   MAC1600          1.0.2           12SL v239" \
+           "                                 {}mm/s    10 mm/mV" \
+           "                                 0.16-20 Hz    1000 Hz                              1/1".format(speed)
+
 
+# annotations on the axes of the paper background (pixel coordinates), returns the bottom annotation text
+def draw_on_ecg(canvas, speed=''):
     # add voltage marker
     gx = 28
     gy = 603
@@ -73,70 +76,170 @@ def draw_on_ecg(figure, speed):
     canvas.text(0.95, 0.95, t2, size='19', transform=canvas.transAxes)
 
     # add bottom annotation line
-    t3 = "GE   MAC1600          1.0.2           12SL v239" \
-         "                                 {}mm/s    10 mm/mV" \
-         "                                 0.16-20 Hz    1000 Hz                              1/1".format(speed)
-    canvas.text(0.085, 0.03, t3, size='19', transform=canvas.transAxes)
+    t3 = get_annotation(speed)
+    speed_text = canvas.text(0.085, 0.03, t3, size='19', transform=canvas.transAxes)
 
     # add black rectangle marker
     rect = patches.Rectangle((43, 638), 25, 28, linewidth=0.1, edgecolor='black', facecolor='black')
     canvas.add_patch(rect)
+    return speed_text
 
 
-# plot ecg
-def plot_data(ecg_data, speed=0, fixed=True, scale=500):
-    img = plt.imread("ecg-paper.jpg")
-    graph = plt.figure(constrained_layout=True, figsize=(24.5, 17.4), dpi=90)
-    plt.imshow(img)
-    plt.axis('off')
+PDF_BATCH = 10  # pages held in memory while a PDF is written
+
+# decoded paper backgrounds by file name, read once
+_papers = {}
+# page of the last plot_data call, the figure is reused by the following calls
+_page = None
+
+
+def get_paper(filename="ecg-paper.jpg"):
+    if filename not in _papers:
+        _papers[filename] = plt.imread(filename)
+    return _papers[filename]
+
+
+def make_page(paper="ecg-paper.jpg", dpi=90):
+    # builds the figure once: paper background, 14 empty lead axes and annotations
+    # the background is rendered once and kept as a bitmap, the following pages only redraw the leads
+    # the default subplot positions, as the sheets of the previous renderer (its constrained layout was not applied)
+    graph = Figure(figsize=(24.5, 17.4), dpi=dpi)
+    canvas = FigureCanvasAgg(graph)
+    paper_axes = graph.add_subplot()
+    paper_axes.imshow(get_paper(paper))
+    paper_axes.axis('off')
     spec = graph.add_gridspec(14, hspace=0)
     axs = spec.subplots(sharex=True, sharey=True)
+    lines = []
+    labels = []
+    for ax in axs:  # for all subplots
+        ax.axis('off')
+        ax.set_xmargin(0.1)
+        lines.append(ax.plot([], [], 'k-', linewidth=1.7, clip_on=False, animated=True)[0])
+        labels.append(ax.annotate('', (0, 320), size='22', animated=True))
+    speed_text = draw_on_ecg(paper_axes)
+    speed_text.set_animated(True)
+
+    canvas.draw()
+    return {"figure": graph, "canvas": canvas, "axes": axs, "lines": lines, "labels": labels,
+            "speed_text": speed_text, "background": canvas.copy_from_bbox(graph.bbox)}
+
+
+def update_page(page, ecg_data, speed=0, fixed=True, scale=500):
+    # puts the leads of ecg_data into the lines of the page (set_data), returns the speed
     if speed == 0:
         speed = int(250000/len(ecg_data[0][0]))
-    for i in range(14):  # for all subplots
-        axs[i].axis('off')
-        axs[i].set_xmargin(0.1)
     if type(ecg_data[1]) == tuple:
-        for i, d in enumerate(ecg_data[0]):
-            axs[i + 1].set_ylim(-scale, scale) if not fixed else True
-            axs[i + 1].plot(d[:int(250000/speed)], 'k-', linewidth=1.7, clip_on=False)
-            label = ecg_data[1][i]
-            axs[i + 1].annotate(label, (0, 320), size='22')
-    elif type(ecg_data[1]) == str:  # if a single lead was passed
-        print("here")
-        axs[6].set_ylim(-scale, scale) if not fixed else True
-        axs[6].plot(ecg_data[0][0][0:int(250000/speed)], 'k-', linewidth=1.7, clip_on=False)
-        label = ecg_data[1]
-        axs[6].annotate(label, (0, 500), size='22')
-    draw_on_ecg(graph, speed)
-    plt.savefig('output.jpg', format='jpg')
-    img = Image.open('output.jpg')
-    img.show()
-
-
-#####################
-# Exec instructions #
-#####################
-
-# 1. Specify needed leads by their names in Carto file
-leads = 'I', 'II', 'III', 'aVR', 'aVL', 'aVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6'
-
-# 2. Create data array from Carto-file using path and lead selection parameter
-data = get_ecg_data("data1/1-SR_P1_ECG_Export.txt", leads)
-data2 = get_ecg_data("data1/1-SR_P1181_ECG_Export.txt", 'CS6')
-
-# 3. Plot, optionally with:
-# - make_longer(multiply) function to multiply tracing to 10 second duration (multiply=True) or pseudo-crop i.e. add 7500 ms of NaN (multiply=False)
-# Experimental functions (don't work flawless yet):
-# - speed argument to make tracing proportional to paper speed
-# - fixed argument that makes spacing between leads even, but voltage goes down (must fix it later)
-# - scale argument to specify maximal y scale (works only if fixed = False; future update to adjust scale to paper scale required)
-
-# Simple usage: will stretch given points to whole sheet
-plot_data(data)
-
-# Example of rhythm strip: repeats points, scales speed at approx. 50mm/s, allows extra space for higher voltage leads
-plot_data(make_longer(data, True), speed=50, fixed=False)
-
-# Example of single lead: allows extra space, scales the y-axis
-plot_data(data2, fixed=False, scale=500)
+        leads = {i + 1: (d, label, 320) for i, (d, label) in enumerate(zip(ecg_data[0], ecg_data[1]))}
+    else:  # if a single lead was passed
+        leads = {6: (ecg_data[0][0], ecg_data[1], 500)}
+    for i, (line, label) in enumerate(zip(page["lines"], page["labels"])):
+        if i in leads:
+            d, text, y = leads[i]
+            d = d[:int(250000/speed)]
+            line.set_data(np.arange(len(d)), d)
+            label.set_text(text)
+            label.xy = (0, y)
+        else:
+            line.set_data([], [])
+            label.set_text('')
+    ax = page["axes"][0]  # x and y are shared by all leads, the limits are computed from the data of all leads
+    if fixed:
+        ax.set_autoscaley_on(True)
+    for lead_ax in page["axes"]:
+        lead_ax.relim()
+    ax.autoscale_view()
+    if not fixed:
+        ax.set_ylim(-scale, scale)
+    page["speed_text"].set_text(get_annotation(speed))
+    return speed
+
+
+def render_page(page):
+    # draws the leads over the cached background, returns the page as PIL image
+    canvas = page["canvas"]
+    canvas.restore_region(page["background"])
+    for artist in page["lines"] + page["labels"] + [page["speed_text"]]:
+        page["figure"].draw_artist(artist)
+    return Image.fromarray(np.asarray(canvas.buffer_rgba())).convert('RGB')
+
+
+def plot_data(ecg_data, speed=0, fixed=True, scale=500, filename=None, show=True):
+    global _page
+    if _page is None:
+        _page = make_page()
+    update_page(_page, ecg_data, speed, fixed, scale)
+    img = render_page(_page)
+    if filename:
+        img.save(filename)
+    if show:
+        img.show()
+    return img
+
+
+def write_pdf(filename, images, dpi=90, quality=90):
+    # writes the images (PIL) as pages of a PDF, one JPEG per page
+    # PIL keeps the images of one save call in memory, so the pages are appended in batches of PDF_BATCH pages
+    # and memory does not grow with the number of pages
+    images = iter(images)
+    append = False
+    while True:
+        batch = list(itertools.islice(images, PDF_BATCH))
+        if not batch:
+            break
+        batch[0].save(filename, format='PDF', save_all=True, append_images=batch[1:], append=append,
+                      resolution=dpi, quality=quality)
+        append = True
+    if not append:
+        raise ValueError('No pages to write to {}'.format(filename))
+
+
+def plot_pages(ecg_datas, filename, speed=0, fixed=True, scale=500):
+    # batch output of many points on one reused page
+    # filename ending with .pdf: multi-page PDF, otherwise a pattern of the image names, e.g. 'point_{:04d}.jpg'
+    page = make_page()
+
+    def render(ecg_data):
+        update_page(page, ecg_data, speed, fixed, scale)
+        return render_page(page)
+
+    if filename.lower().endswith('.pdf'):
+        write_pdf(filename, (render(ecg_data) for ecg_data in ecg_datas), dpi=page["figure"].dpi)
+        return filename
+    filenames = []
+    for i, ecg_data in enumerate(ecg_datas):
+        filenames.append(filename.format(i))
+        render(ecg_data).save(filenames[-1])
+    return filenames
+
+
+if __name__ == '__main__':
+    #####################
+    # Exec instructions #
+    #####################
+
+    # 1. Specify needed leads by their names in Carto file
+    leads = 'I', 'II', 'III', 'aVR', 'aVL', 'aVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6'
+
+    # 2. Create data array from Carto-file using path and lead selection parameter
+    data = get_ecg_data("data1/1-SR_P1_ECG_Export.txt", leads)
+    data2 = get_ecg_data("data1/1-SR_P1181_ECG_Export.txt", 'CS6')
+
+    # 3. Plot, optionally with:
+    # - make_longer(multiply) function to multiply tracing to 10 second duration (multiply=True) or pseudo-crop i.e. add 7500 ms of NaN (multiply=False)
+    # Experimental functions (don't work flawless yet):
+    # - speed argument to make tracing proportional to paper speed
+    # - fixed argument that makes spacing between leads even, but voltage goes down (must fix it later)
+    # - scale argument to specify maximal y scale (works only if fixed = False; future update to adjust scale to paper scale required)
+
+    # Simple usage: will stretch given points to whole sheet
+    plot_data(data)
+
+    # Example of rhythm strip: repeats points, scales speed at approx. 50mm/s, allows extra space for higher voltage leads
+    plot_data(make_longer(data, True), speed=50, fixed=False)
+
+    # Example of single lead: allows extra space, scales the y-axis
+    plot_data(data2, fixed=False, scale=500)
+
+    # Many points: one multi-page PDF (or an image per point with filename='point_{:04d}.jpg')
+    plot_pages([data, make_longer(data, True)], 'output.pdf')
@@ -1,18 +1,26 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
 from PIL import Image
-import numpy as np
 import re
 from zipfile import ZipFile, is_zipfile
 import os
 from tqdm import tqdm
 
+import ecg_writer
+
+LEADS = 'I', 'II', 'III', 'aVR', 'aVL', 'aVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6'
+FILES_PER_TASK = 20  # printouts per task of write_printouts
+# page of the 12-lead sheets (ecg_writer.make_page), made once per process
+_page = None
+
 
 # opens a zip file and gets _ECG_Export.txt -files
 def get_files_from_zip(zip_filename, limit = 3):
     """
     gets list of filenames from zip archive
     :param zip_filename: name of zip archive with data files
+    :param limit: maximal number of files, all files if None
     :return: list of ecg files
     """
     ecg_file_list = []
@@ -25,7 +33,7 @@ def get_files_from_zip(zip_filename, limit = 3):
             # iteration though all files in zip archive
             for filename in filename_list:
                 ecg_file = re.search('(.*)_ECG_Export.txt', filename)
-                if ecg_file and count < limit:
+                if ecg_file and (limit is None or count < limit):
                     ecg_file_list.append(ecg_file.string)
                     count = count + 1
     return ecg_file_list
@@ -33,34 +41,10 @@ def get_files_from_zip(zip_filename, limit = 3):
 
 # gets 12 lead data from file given channel names
 def get_ecg_data_from_zip(zip_file, filename, ders):
-    if filename in zip_file.namelist():
-        lines = zip_file.read(filename).splitlines()
-        derivations = {}  # make and populate a dictionary out of a tuple
-        if type(ders) == tuple:
-            for i, der in enumerate(ders):
-                derivations["d" + str(i)] = der
-            channels = np.empty((0, len(derivations)), int)
-        elif type(ders) == str:  # if a single lead was passed
-            derivations["d0"] = ders
-            channels = np.empty((0, 1), int)
-        indices = {}
-        read_data = False
-        for i, line in enumerate(lines):
-            if read_data:  # get the data at indices
-                newline = np.fromstring(line.decode('utf8'), dtype=int, sep=' ')
-                channel_array = []
-                for key in derivations:
-                    channel_array.append(newline[indices["%s_index" % key]])
-                channels = np.append(channels, [channel_array], axis=0)
-            if i == 3:  # find columns with specified leads and save their index
-                read_data = True
-                channel_names = line.decode('utf8').split()
-                for j, c in enumerate(channel_names):
-                    result = re.search('(.*)\(.', c)
-                    channel_names[j] = result.group(1)
-                for k, d in enumerate(derivations):
-                    indices["d%s_index" % k] = channel_names.index(derivations["d" + str(k)])
-    return np.transpose(channels), ders, filename  # return ecg data, lead names and file name
+    if filename not in zip_file.namelist():
+        raise NameError('File {} not found in zip archive!'.format(filename))
+    ecg_data = ecg_writer.read_leads(zip_file.read(filename).decode('utf8'), ders)
+    return ecg_data, ders, filename  # return ecg data, lead names and file name
 
 
 # annotations
@@ -125,7 +109,66 @@ def get_data_from_zip(zip_filename, lead):
     return data_array
 
 
-# Execute
-data = get_data_from_zip('C:/Users/stans/Downloads/Export_2021E150-04_08_2021-14-49-19.zip', 'I')
-for d in data:
-    plot_data(d)
+def _write_printouts_task(zip_filename, ecg_files, output_dir, leads, image_format):
+    """
+    process pool worker of write_printouts: renders the 12-lead sheets of ecg_files with the Agg canvas
+    of ecg_writer (no window is opened) and writes them to output_dir
+    :return: list of written file names
+    """
+    global _page
+    if _page is None:
+        _page = ecg_writer.make_page()
+    filenames = []
+    with ZipFile(zip_filename, 'r') as zip_file:
+        for ecg_file in ecg_files:
+            ecg_data, ders, _ = get_ecg_data_from_zip(zip_file, ecg_file, tuple(leads))
+            ecg_writer.update_page(_page, (ecg_data, ders))
+            filenames.append(os.path.join(output_dir, 'output_{}.{}'.format(
+                os.path.basename(ecg_file)[:-4], image_format)))
+            ecg_writer.render_page(_page).save(filenames[-1])
+    return filenames
+
+
+def write_printouts(zip_filename, output_dir, leads=LEADS, workers=None, files_per_task=FILES_PER_TASK,
+                    image_format='jpg'):
+    """
+    batch mode: renders the 12-lead sheet of every _ECG_Export.txt in the zip archive (see ecg_writer.plot_data)
+    and writes it to output_dir as output_<name of the ecg file>.<image_format>
+    the files are split into tasks of files_per_task files and rendered in a process pool,
+    a file is always rendered the same way, so the output does not depend on the number of workers
+    :param zip_filename: name of zip archive with data files
+    :param output_dir: directory of the printouts, created if not exists
+    :param leads: names of the leads in the ecg files
+    :param workers: number of processes (None = number of CPUs), serially if workers == 1
+    :param files_per_task: number of files per task
+    :param image_format: 'jpg' or 'png'
+    :return: sorted list of written file names
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    ecg_files = sorted(get_files_from_zip(zip_filename, limit=None))
+    tasks = [ecg_files[start:start + files_per_task] for start in range(0, len(ecg_files), files_per_task)]
+    filenames = []
+    with tqdm(total=len(ecg_files), desc="Printing from {0}".format(os.path.basename(zip_filename)), ascii=False,
+              ncols=150, colour='green', leave=True) as pbar:
+        if workers == 1:
+            for task in tasks:
+                filenames += _write_printouts_task(zip_filename, task, output_dir, leads, image_format)
+                pbar.update(len(task))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_write_printouts_task, zip_filename, task, output_dir, leads, image_format)
+                           for task in tasks]
+                for future in as_completed(futures):
+                    filenames += future.result()
+                    pbar.update(len(filenames) - pbar.n)
+    return sorted(filenames)
+
+
+if __name__ == '__main__':
+    # Execute
+    data = get_data_from_zip('C:/Users/stans/Downloads/Export_2021E150-04_08_2021-14-49-19.zip', 'I')
+    for d in data:
+        plot_data(d)
+
+    # 12-lead sheets of all points of the study
+    write_printouts('C:/Users/stans/Downloads/Export_2021E150-04_08_2021-14-49-19.zip', 'printouts')
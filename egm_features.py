@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+import cartoutils
+import datastore
+
+# table of standard EGM features of every point and channel (one row of FEATURE_DTYPE per point),
+# computed in chunks of points and saved next to the dataset, so it is computed once
+FEATURES_FILE = 'egm_features.bin'
+FEATURES_INDEX_FILE = 'egm_features.json'
+FEATURE_DTYPE = np.dtype([('ptp', 'f4', (len(cartoutils.Mapping_Channels),)),         # peak-to-peak, ecg units
+                          ('lat', 'f4', (len(cartoutils.Mapping_Channels),)),         # local activation time, ms
+                          ('duration', 'f4', (len(cartoutils.Mapping_Channels),)),    # signal duration, ms
+                          ('deflections', 'i2', (len(cartoutils.Mapping_Channels),))])  # number of deflections
+ECG_RATE = 1000             # ECG samples per second
+CHUNK_POINTS = 256          # points per chunk, memory is about 10 x CHUNK_POINTS x 6 x 2500 float32
+DURATION_FRACTION = 0.2     # the signal is active above this fraction of its maximal amplitude
+DEFLECTION_FRACTION = 0.1   # extrema below this fraction of the maximal amplitude are not counted
+
+
+def compute_features(ecg_data, window=None, channels=cartoutils.Mapping_Channels, rate=ECG_RATE,
+                     duration_fraction=DURATION_FRACTION, deflection_fraction=DEFLECTION_FRACTION,
+                     chunk_points=CHUNK_POINTS, progress=True):
+    """
+    EGM features of all points and channels, vectorized over the points of a chunk
+    the signal is taken relative to its median (baseline) in the window
+    ptp: max - min (ecg units, cartoutils.ecg_to_mv converts them to mV)
+    lat: unipolar channels - the steepest downslope (max -dV/dt), bipolar channels - the maximal |V|,
+         ms from the first sample of the ECG, NaN for a flat EGM
+    duration: ms from the first to the last sample above duration_fraction of the maximal |V|
+    deflections: extrema of the signal (changes of the sign of the slope) above deflection_fraction of the maximal |V|
+    :param ecg_data: ecg data with the shape = (#of points, len(channels), 2500), memory-mapped arrays
+            are read chunk by chunk
+    :param window: (start, stop) samples of the window of interest, whole ECG by default
+            (the duration of a window with several beats spans all of them)
+    :param channels: names of the channels (bipolar channels contain '-'), Mapping_Channels by default
+    :param rate: ECG samples per second
+    :param duration_fraction: see duration
+    :param deflection_fraction: see deflections
+    :param chunk_points: number of points per chunk
+    :param progress: show the progress bar
+    :return: Numpy array of FEATURE_DTYPE with one row per point
+    """
+    start, stop = window or (0, ecg_data.shape[2])
+    bipolar = np.array(['-' in channel for channel in channels])
+    ms = 1000. / rate
+    features = np.empty(len(ecg_data), FEATURE_DTYPE)
+    with tqdm(total=len(ecg_data), desc="EGM features ...", ascii=False, ncols=150, colour='green', leave=True,
+              disable=not progress) as pbar:
+        for chunk_start in range(0, len(ecg_data), chunk_points):
+            # a copy, the median is subtracted in place and ecg_data may be float32 (or a read-only memmap)
+            x = np.array(ecg_data[chunk_start:chunk_start + chunk_points, :, start:stop], dtype=np.float32)
+            x -= np.median(x, axis=-1, keepdims=True)
+            amplitude = np.abs(x)
+            peak = amplitude.max(axis=-1, keepdims=True)
+            flat = peak[..., 0] == 0
+            slope = np.diff(x, axis=-1)
+            rows = features[chunk_start:chunk_start + len(x)]
+
+            rows['ptp'] = x.max(axis=-1) - x.min(axis=-1)
+
+            lat = np.where(bipolar, np.argmax(amplitude, axis=-1), np.argmin(slope, axis=-1)).astype(np.float32)
+            lat[flat] = np.nan
+            rows['lat'] = (lat + start) * ms
+
+            active = amplitude > duration_fraction * peak
+            first = np.argmax(active, axis=-1)
+            last = active.shape[-1] - 1 - np.argmax(active[..., ::-1], axis=-1)
+            rows['duration'] = np.where(flat, 0, last - first) * ms
+
+            # sign of the slope, flat parts take the sign before them, so a plateau counts as one extremum
+            sign = np.sign(slope)
+            before = np.maximum.accumulate(np.where(sign != 0, np.arange(sign.shape[-1]), 0), axis=-1)
+            sign = np.take_along_axis(sign, before, axis=-1)
+            extrema = (sign[..., 1:] * sign[..., :-1] < 0) & (amplitude[..., 1:-1] > deflection_fraction * peak)
+            rows['deflections'] = extrema.sum(axis=-1)
+            pbar.update(len(x))
+    return features
+
+
+def _fingerprint(ecg_data, count):
+    # hash of a sample of the first count rows (up to 64 rows and the last one),
+    # the saved features are not reused if these rows were changed
+    if count == 0:
+        return ''
+    rows = sorted(set(range(0, count, max(count // 64, 1))) | {count - 1})
+    digest = hashlib.sha1()
+    for row in rows:
+        digest.update(np.ascontiguousarray(ecg_data[row]).tobytes())
+    return digest.hexdigest()
+
+
+def load_features(data_directory):
+    """
+    loads the saved features of the dataset (memory-mapped)
+    :param data_directory: directory of the dataset
+    :return: Numpy array of FEATURE_DTYPE, None if no features are saved
+    """
+    index_filename = os.path.join(data_directory, FEATURES_INDEX_FILE)
+    if not os.path.exists(index_filename):
+        return None
+    with open(index_filename, 'r') as file:
+        count = json.load(file)["count"]
+    if count == 0:
+        return np.empty(0, FEATURE_DTYPE)
+    return np.memmap(os.path.join(data_directory, FEATURES_FILE), dtype=FEATURE_DTYPE, mode='r', shape=(count,))
+
+
+def get_features(data_directory, ecg_data, window=None, channels=cartoutils.Mapping_Channels, rate=ECG_RATE,
+                 duration_fraction=DURATION_FRACTION, deflection_fraction=DEFLECTION_FRACTION,
+                 chunk_points=CHUNK_POINTS, recompute=False):
+    """
+    features of all points of the dataset, saved in data_directory (egm_features.bin / .json)
+    the first call computes them, the following calls load the saved table, only the points appended to the dataset
+    since the last call are computed (e.g. datastore.open_store after zip_to_store)
+    the features are computed again if the parameters or the saved rows of ecg_data changed
+    :param data_directory: directory of the dataset, e.g. of cartoutils.load_data() or datastore.open_store()
+    :param ecg_data: ecg data of the dataset with the shape = (#of points, len(channels), 2500)
+    :param recompute: compute the features of all points again
+    other parameters: see compute_features()
+    :return: Numpy array of FEATURE_DTYPE with one row per point of ecg_data (memory-mapped)
+    """
+    parameters = {"window": list(window) if window else None, "channels": list(channels), "rate": rate,
+                  "duration_fraction": duration_fraction, "deflection_fraction": deflection_fraction}
+    index_filename = os.path.join(data_directory, FEATURES_INDEX_FILE)
+    index = {"count": 0}
+    if os.path.exists(index_filename) and not recompute:
+        with open(index_filename, 'r') as file:
+            index = json.load(file)
+        if (index.get("parameters") != parameters or index["count"] > len(ecg_data)
+                or index.get("fingerprint") != _fingerprint(ecg_data, index["count"])):
+            index = {"count": 0}
+    count = index["count"]
+
+    with tqdm(total=len(ecg_data) - count, desc="EGM features ...", ascii=False,
+              ncols=150, colour='green', leave=True, disable=count == len(ecg_data)) as pbar:
+        for chunk_start in range(count, len(ecg_data), chunk_points):
+            chunk = ecg_data[chunk_start:chunk_start + chunk_points]
+            datastore.append_rows(os.path.join(data_directory, FEATURES_FILE),
+                                  compute_features(chunk, window, channels, rate, duration_fraction,
+                                                   deflection_fraction, chunk_points, progress=False), chunk_start)
+            # the count is saved after every chunk, so an interrupted run continues from the last chunk
+            count = chunk_start + len(chunk)
+            cartoutils.save_json(index_filename, {"count": count, "parameters": parameters,
+                                                  "fingerprint": _fingerprint(ecg_data, count)})
+            pbar.update(len(chunk))
+    if count == 0:  # empty dataset
+        cartoutils.save_json(index_filename, {"count": 0, "parameters": parameters, "fingerprint": ''})
+    return load_features(data_directory)
@@ -0,0 +1,198 @@
+import json
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+import cartoutils
+import datastore
+import matching
+
+# approximate nearest neighbour index over the morphology of the EGMs (inverted file, IVF):
+# every EGM (point, channel) is described by a short feature vector, the vectors are clustered by k-means
+# and a query compares only the vectors of the nearest clusters, the candidates are reranked by matching.similarity
+INDEX_FILE = 'egm_index.json'
+CENTROIDS_FILE = 'centroids.npy'
+FEATURES_FILE = 'features.bin'
+LISTS_FILE = 'lists.bin'
+DOWNSAMPLE = 5      # samples averaged into one before the spectrum is computed
+FEATURE_BINS = 64   # lowest frequency bins of the spectrum (without DC) in the feature vector
+KMEANS_ITERATIONS = 10
+
+
+def get_features(egms, length=cartoutils.ECG_SAMPLES, downsample=DOWNSAMPLE, bins=FEATURE_BINS):
+    """
+    feature vectors of EGMs: magnitude spectrum of the downsampled, normalized EGM,
+    it does not depend on the position of the deflections, so EGMs of the same morphology are close
+    at any lag (the lag is found by matching.similarity when reranking)
+    :param egms: array of EGMs with shape = (..., samples), samples <= length (shorter EGMs are zero-padded)
+    :param length: number of samples of the indexed EGMs, the spectra of all EGMs have the same frequency bins
+    :param downsample: samples averaged into one
+    :param bins: number of frequency bins
+    :return: float32 Numpy array with shape = (..., bins), unit length
+    """
+    egms = np.asarray(egms, dtype=float)
+    samples = egms.shape[-1] // downsample * downsample
+    egms = egms[..., :samples].reshape(egms.shape[:-1] + (-1, downsample)).mean(axis=-1)
+    egms = egms - egms.mean(axis=-1, keepdims=True)
+    spectrum = np.abs(np.fft.rfft(egms, length // downsample))[..., 1:bins + 1]
+    norm = np.linalg.norm(spectrum, axis=-1, keepdims=True)
+    norm[norm == 0] = 1  # flat EGM
+    return (spectrum / norm).astype(np.float32)
+
+
+def _nearest_centroids(features, centroids, count=1, chunk=65536):
+    # indexes of the count nearest centroids of every vector, computed in chunks of vectors
+    nearest = np.empty((len(features), count), np.int32)
+    centroid_norms = np.sum(centroids * centroids, axis=1)
+    for start in range(0, len(features), chunk):
+        distances = centroid_norms - 2 * features[start:start + chunk] @ centroids.T
+        if count == 1:
+            nearest[start:start + chunk, 0] = np.argmin(distances, axis=1)
+        else:
+            nearest[start:start + chunk] = np.argsort(distances, axis=1)[:, :count]
+    return nearest
+
+
+def train_centroids(features, lists, iterations=KMEANS_ITERATIONS, seed=0):
+    """
+    k-means clustering of the feature vectors (Lloyd's algorithm on a sample of at most 64 vectors per list)
+    :param features: feature vectors with shape = (n, bins)
+    :param lists: number of clusters (lists of the index)
+    :return: float32 Numpy array of centroids with shape = (lists, bins)
+    """
+    rng = np.random.default_rng(seed)
+    sample = features[np.sort(rng.choice(len(features), min(len(features), 64 * lists), replace=False))]
+    centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+    for _ in range(iterations):
+        nearest = _nearest_centroids(sample, centroids)[:, 0]
+        counts = np.bincount(nearest, minlength=lists)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, nearest, sample)
+        # empty clusters keep their centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+    return centroids
+
+
+def load_index(index_dir):
+    """
+    loads the index, the feature vectors are memory-mapped
+    :param index_dir: directory of the index
+    :return: index dictionary, "order" and "bounds" give the vectors of every list
+             (vectors order[bounds[i]:bounds[i + 1]] are in list i)
+    """
+    with open(os.path.join(index_dir, INDEX_FILE), 'r') as file:
+        index = json.load(file)
+    index["centroids"] = np.load(os.path.join(index_dir, CENTROIDS_FILE))
+    count = index["count"] * index["channels"]
+    if count:
+        index["features"] = np.memmap(os.path.join(index_dir, FEATURES_FILE), dtype=np.float32, mode='r',
+                                      shape=(count, index["bins"]))
+        lists = np.fromfile(os.path.join(index_dir, LISTS_FILE), dtype=np.int32, count=count)
+    else:
+        index["features"] = np.empty((0, index["bins"]), np.float32)
+        lists = np.empty(0, np.int32)
+    index["order"] = np.argsort(lists, kind='stable')
+    index["bounds"] = np.searchsorted(lists[index["order"]], np.arange(len(index["centroids"]) + 1))
+    return index
+
+
+def add_to_index(index_dir, ecg_data, chunk_points=matching.CHUNK_POINTS):
+    """
+    adds the points of ecg_data which are not yet in the index (rows from index["count"] on),
+    so the index follows a dataset which grows by appending, e.g. the datastore (datastore.open_store)
+    the new vectors are assigned to the existing clusters
+    :param index_dir: directory of the index
+    :param ecg_data: ecg data with the shape = (#of points, len(Mapping_channels), 2500), memory-mapped arrays
+            are read chunk by chunk
+    :param chunk_points: number of points per chunk
+    :return: number of added points
+    """
+    index = load_index(index_dir)
+    start = index["count"]
+    if len(ecg_data) <= start:
+        return 0
+    with tqdm(total=len(ecg_data) - start, desc="Indexing ...", ascii=False,
+              ncols=150, colour='green', leave=True) as pbar:
+        for chunk_start in range(start, len(ecg_data), chunk_points):
+            chunk = ecg_data[chunk_start:chunk_start + chunk_points]
+            features = get_features(chunk, index["samples"], index["downsample"], index["bins"]).reshape(
+                -1, index["bins"])
+            count = chunk_start * index["channels"]
+            datastore.append_rows(os.path.join(index_dir, FEATURES_FILE), features, count)
+            datastore.append_rows(os.path.join(index_dir, LISTS_FILE),
+                                  _nearest_centroids(features, index["centroids"])[:, 0], count)
+            # the count is saved after every chunk, so an interrupted add continues from the last chunk
+            index["count"] = chunk_start + len(chunk)
+            _save_index(index_dir, index)
+            pbar.update(len(chunk))
+    return len(ecg_data) - start
+
+
+def _save_index(index_dir, index):
+    cartoutils.save_json(os.path.join(index_dir, INDEX_FILE),
+                         {key: value for key, value in index.items() if not isinstance(value, np.ndarray)})
+
+
+def build_index(index_dir, ecg_data, lists=None, downsample=DOWNSAMPLE, bins=FEATURE_BINS, seed=0):
+    """
+    builds a new index of all EGMs (every point and channel) of ecg_data, replaces an existing index
+    :param index_dir: directory of the index, created if not exists
+    :param ecg_data: ecg data with the shape = (#of points, len(Mapping_channels), 2500) from cartoutils.load_data()
+            or datastore.open_store(), row numbers of this array are the point numbers in the results of query()
+    :param lists: number of clusters, 4 * sqrt(#of EGMs) by default (max 1024)
+    :param downsample: see get_features()
+    :param bins: see get_features()
+    :param seed: seed of the k-means sample
+    :return: loaded index, see load_index()
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    channels, samples = ecg_data.shape[1], ecg_data.shape[2]
+    if lists is None:
+        lists = int(min(1024, max(1, 4 * np.sqrt(len(ecg_data) * channels))))
+    # the k-means sample is taken from a subset of the points, the features of all points are computed in add_to_index
+    rng = np.random.default_rng(seed)
+    sample_points = np.sort(rng.choice(len(ecg_data), min(len(ecg_data), max(64 * lists // channels, 1)),
+                                       replace=False))
+    sample = get_features(ecg_data[sample_points], samples, downsample, bins).reshape(-1, bins)
+    centroids = train_centroids(sample, min(lists, len(sample)), seed=seed)
+
+    for filename in (FEATURES_FILE, LISTS_FILE):
+        if os.path.exists(os.path.join(index_dir, filename)):
+            os.remove(os.path.join(index_dir, filename))
+    np.save(os.path.join(index_dir, CENTROIDS_FILE), centroids)
+    _save_index(index_dir, {"count": 0, "channels": channels, "samples": samples, "downsample": downsample,
+                            "bins": bins})
+    add_to_index(index_dir, ecg_data)
+    return load_index(index_dir)
+
+
+def query(index, ecg_data, egm, k=10, probes=8, candidates=200):
+    """
+    finds the points and channels with EGMs looking like egm
+    1) the feature vectors in the probes lists nearest to the feature vector of egm are compared,
+    2) the candidates nearest vectors are reranked by matching.similarity(egm, EGM of the candidate)
+    :param index: index from load_index() or build_index()
+    :param ecg_data: indexed ecg data (same rows as when the index was built)
+    :param egm: EGM with the number of samples of the indexed EGMs
+            (the spectrum of a short template differs from the spectrum of the EGM, use matching.search)
+    :param k: number of results
+    :param probes: number of searched lists, more lists - better recall, slower query
+    :param candidates: number of reranked EGMs
+    :return: list of up to k (point, channel, lag, score) sorted by descending score as matching.search()
+    """
+    if len(egm) != index["samples"]:
+        raise ValueError('EGM of {} samples, the index is built of {} samples'.format(len(egm), index["samples"]))
+    feature = get_features(egm, index["samples"], index["downsample"], index["bins"])
+    lists = _nearest_centroids(feature[np.newaxis], index["centroids"], min(probes, len(index["centroids"])))[0]
+    ids = np.concatenate([index["order"][index["bounds"][i]:index["bounds"][i + 1]] for i in lists])
+    if len(ids) > candidates:
+        distances = -(index["features"][ids] @ feature)
+        ids = ids[np.argpartition(distances, candidates - 1)[:candidates]]
+    ids = np.sort(ids)  # rows of memory-mapped ecg_data are read in order
+    points, channels = np.divmod(ids, index["channels"])
+    lags, scores = matching.best_lags(egm, np.asarray(ecg_data[points, channels]), method='similarity')
+    results = [(int(point), int(channel), int(lag), float(score))
+               for point, channel, lag, score in zip(points, channels, lags, scores) if not np.isnan(score)]
+    return sorted(results, key=lambda result: (-result[3], result[0], result[1]))[:k]
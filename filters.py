@@ -0,0 +1,84 @@
+import numpy as np
+from scipy import signal
+from tqdm import tqdm
+
+# zero-phase IIR filters of the signals along the last axis, e.g. the ecg data of a study (#of points, channels, 2500)
+# or the channels of an EP recording from simple.get_channels (channels, samples)
+# the filters are second-order sections (sos), the bandpass, the notches and the baseline removal are one cascade
+# applied forward and backward by one sosfiltfilt call per chunk
+FILTER_RATE = 1000          # samples per second of the ECG
+FILTER_ORDER = 2            # order of the Butterworth filters, doubled by the forward-backward filtering
+NOTCH_Q = 30                # quality factor of the notch filters
+BASELINE_CUTOFF = 0.5       # Hz, high-pass of the baseline wander removal
+ECG_BANDPASS = (0.16, 20)   # Hz, band of the ECG printouts (see ecg_writer.get_annotation)
+CHUNK_POINTS = 256          # rows of the first axis per chunk
+
+
+def make_filter(rate=FILTER_RATE, bandpass=None, notch=None, baseline=None, order=FILTER_ORDER):
+    """
+    second-order sections of the filter cascade
+    :param rate: samples per second
+    :param bandpass: (low, high) Hz of the Butterworth bandpass, None for no bandpass,
+            low or high None gives a high-pass or a low-pass
+    :param notch: Hz of the mains notch (50 or 60), a tuple for several notches (e.g. harmonics), None for no notch
+    :param baseline: cutoff Hz of the baseline wander removal (high-pass), True for BASELINE_CUTOFF, None for none
+    :param order: order of the Butterworth filters
+    :return: Numpy array of second-order sections with the shape = (sections, 6)
+    """
+    sections = []
+    low, high = bandpass or (None, None)
+    if low and high:
+        sections.append(signal.butter(order, (low, high), 'bandpass', fs=rate, output='sos'))
+    elif low:
+        sections.append(signal.butter(order, low, 'highpass', fs=rate, output='sos'))
+    elif high:
+        sections.append(signal.butter(order, high, 'lowpass', fs=rate, output='sos'))
+    if baseline:
+        cutoff = BASELINE_CUTOFF if baseline is True else baseline
+        sections.append(signal.butter(order, cutoff, 'highpass', fs=rate, output='sos'))
+    for frequency in np.atleast_1d(notch if notch is not None else []):
+        sections.append(signal.tf2sos(*signal.iirnotch(frequency, NOTCH_Q, fs=rate)))
+    if not sections:
+        raise ValueError('No filter, specify bandpass, notch or baseline')
+    return np.concatenate(sections)
+
+
+def filter_signals(data, rate=FILTER_RATE, bandpass=None, notch=None, baseline=None, order=FILTER_ORDER,
+                   chunk_points=CHUNK_POINTS, in_place=False, out=None, progress=False):
+    """
+    zero-phase filtering of all signals along the last axis, e.g.
+    filter_signals(ecg_data, bandpass=ECG_BANDPASS, notch=50)
+    the rows of the first axis are filtered in chunks, so a memory-mapped dataset is read (and written) chunk by chunk
+    and the temporary memory is about chunk_points rows
+    :param data: Numpy array (or memory-mapped array) with the signals along the last axis
+    :param rate: samples per second
+    :param bandpass: see make_filter()
+    :param notch: see make_filter()
+    :param baseline: see make_filter()
+    :param order: see make_filter()
+    :param chunk_points: rows of the first axis per chunk, None for all rows at once
+    :param in_place: write the filtered signals into data (a floating point array, memory-mapped with mode='r+'),
+            no copy of data is made
+    :param out: array to write the filtered signals into (e.g. a memory-mapped array), a new array by default
+    :param progress: show the progress bar
+    :return: the filtered signals: data if in_place, out if specified, otherwise a new array of float32
+             for float32 data and integers up to 16 bits (e.g. compact int16 ecg data, exact in float32),
+             float64 for other data (np.result_type of the data and float32)
+    """
+    if in_place:
+        if not np.issubdtype(data.dtype, np.floating):
+            raise ValueError('in_place needs floating point data, not {}'.format(data.dtype))
+        out = data
+    elif out is None:
+        out = np.empty(data.shape, np.result_type(data.dtype, np.float32))
+    elif out.shape != data.shape:
+        raise ValueError('Shape of out {} differs from the shape of data {}'.format(out.shape, data.shape))
+    sos = make_filter(rate, bandpass, notch, baseline, order)
+    chunk_points = chunk_points or max(len(data), 1)
+    with tqdm(total=len(data), desc="Filtering ...", ascii=False, ncols=150, colour='green', leave=True,
+              disable=not progress) as pbar:
+        for chunk_start in range(0, len(data), chunk_points):
+            chunk = slice(chunk_start, chunk_start + chunk_points)
+            out[chunk] = signal.sosfiltfilt(sos, data[chunk], axis=-1)
+            pbar.update(len(out[chunk]))
+    return out
@@ -0,0 +1,241 @@
+import heapq
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# template matching of EGMs (see Signal_matching.ipynb), vectorized over all lags of the template in the signal
+# the functions accept one signal or many signals with the samples in the last axis, e.g. ecg data of a study
+CHUNK_LAGS = 4096  # windows per chunk of sliding_match, memory is CHUNK_LAGS x len(template) floats
+CHUNK_POINTS = 64  # points per chunk of search
+POOL_MIN_POINTS = 2000  # smaller studies are searched serially, starting the process pool costs more than it saves
+
+
+def _fft_size(n):
+    # power of 2 >= n, fast for np.fft
+    return 1 << max(int(n) - 1, 0).bit_length()
+
+
+def _check_lengths(template, signal, min_length=1):
+    m, n = len(template), signal.shape[-1]
+    if template.ndim != 1 or m < min_length or n < m:
+        raise ValueError('Template of {} samples does not fit into the signal of {} samples'.format(m, n))
+    return m, n - m + 1
+
+
+def window_sums(signal, m):
+    # sums of all windows of m samples in the last axis from the cumulative sum
+    cumsum = np.cumsum(signal, axis=-1)
+    window_sum = cumsum[..., m - 1:].copy()
+    window_sum[..., 1:] -= cumsum[..., :-m]
+    return window_sum
+
+
+def sliding_correlation(template, signal):
+    """
+    Pearson correlation coefficient of the template with every window of the signal of the same length,
+    computed for all lags at once: the covariance by FFT cross-correlation,
+    the means and variances of the windows by running sums
+    windows (or template) without variance give NaN as scipy.stats.pearsonr
+    :param template: 1d array with len(template) <= len(signal)
+    :param signal: 1d array or array of signals with shape = (..., samples)
+    :return: Numpy array with shape = (..., samples - len(template) + 1), r at every lag
+    """
+    template = np.asarray(template, dtype=float)
+    signal = np.asarray(signal, dtype=float)
+    m, lags = _check_lengths(template, signal, min_length=2)
+
+    # the signal is centered to keep the running sums small
+    signal = signal - signal.mean(axis=-1, keepdims=True)
+    template = template - template.mean()
+
+    # sum(template[j] * signal[i + j]) for every lag i, the template is centered so this is m * covariance
+    size = _fft_size(signal.shape[-1])
+    covariance = np.fft.irfft(np.fft.rfft(signal, size) * np.conj(np.fft.rfft(template, size)), size)[..., :lags]
+
+    # sums of the windows from the cumulative sums
+    window_sum = window_sums(signal, m)
+    window_sum2 = window_sums(signal * signal, m)
+    window_variance = window_sum2 - window_sum * window_sum / m   # m * variance of every window
+
+    template_variance = np.dot(template, template)
+    # rounding leaves a tiny variance in constant windows
+    constant = window_variance <= 1e-10 * np.maximum(window_sum2, np.finfo(float).tiny)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = covariance / np.sqrt(window_variance * template_variance)
+    r[constant] = np.nan
+    if template_variance == 0:
+        r[...] = np.nan
+    return np.clip(r, -1., 1.)
+
+
+def normalized_cross_correlation(template, signal):
+    """
+    vectorized version of correlate_signals() from Signal_matching.ipynb
+    :param template: template, len(signal) > len(template)
+    :param signal: signal
+    :return: cross correlation coefficient (from -1 to 1), zero-padded template signal for plotting,
+             time of the best correlation
+    """
+    rr = sliding_correlation(template, signal)
+    # NaN windows are ignored as by np.nanmax (np.argmax in the notebook returns the first NaN window)
+    best_i = 0 if np.isnan(rr).all() else np.nanargmax(rr)
+    padded_template = np.append(np.zeros(best_i), template)
+    return np.nanmax(rr), padded_template, best_i
+
+
+def matching(a, b):
+    """
+    matches two signals of equal length using unmatched area normalized by sum of the areas
+    :return: match (from 0 to 1), NaN if the signals are of different length
+    """
+    if len(a) != len(b):
+        print('Error: signals are of different lenght!')
+        return float('NaN')
+    return 1 - np.sum(abs(a-b))/(np.sum(abs(a)) + np.sum(abs(b)))
+
+
+def sliding_match(template, signal, chunk_size=CHUNK_LAGS):
+    """
+    matching() of the template with every window of the signal of the same length
+    sum|window| is taken from the cumulative sum of |signal|, sum|template - window| is computed
+    for chunk_size windows at once on a sliding window view, so the memory is bounded by chunk_size x len(template)
+    for integer signals (EGMs) the scores are identical to matching() at every lag
+    :param template: 1d array with len(template) <= len(signal)
+    :param signal: 1d array or array of signals with shape = (..., samples)
+    :param chunk_size: number of windows per chunk (lags x signals)
+    :return: Numpy array with shape = (..., samples - len(template) + 1), match at every lag
+    """
+    template = np.asarray(template, dtype=float)
+    signal = np.asarray(signal, dtype=float)
+    m, lags = _check_lengths(template, signal)
+
+    area = np.sum(np.abs(template)) + window_sums(np.abs(signal), m)
+
+    windows = sliding_window_view(signal, m, axis=-1)
+    unmatched = np.empty(signal.shape[:-1] + (lags,))
+    step = max(chunk_size // max(int(np.prod(signal.shape[:-1])), 1), 1)
+    for start in range(0, lags, step):
+        chunk = windows[..., start:start + step, :] - template
+        np.abs(chunk, out=chunk)
+        unmatched[..., start:start + step] = chunk.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - unmatched / area
+
+
+def match(template, signal, chunk_size=CHUNK_LAGS):
+    """
+    vectorized version of match() from Signal_matching.ipynb
+    :param template: template, len(signal) > len(template)
+    :param signal: signal
+    :param chunk_size: number of lags per chunk, see sliding_match()
+    :return: match (from 0 to 1), zero-padded template signal for plotting, time of the best match
+    """
+    mm = sliding_match(template, signal, chunk_size)
+    best_i = 0 if np.isnan(mm).all() else np.nanargmax(mm)
+    padded_template = np.append(np.zeros(best_i), template)
+    return np.nanmax(mm), padded_template, best_i
+
+
+def similarity(template, signal):
+    """
+    1) finds the best correlated position (normalized_cross_correlation)
+    2) matches the signals at this position (matching)
+    :param template: template, len(signal) > len(template)
+    :param signal: signal
+    :return: match (from 0 to 1), zero-padded template signal for plotting, time of the best correlation
+    """
+    _, padded_template, best_i = normalized_cross_correlation(template, signal)
+    m = matching(np.asarray(template, dtype=float), np.asarray(signal, dtype=float)[best_i:best_i + len(template)])
+    return m, padded_template, best_i
+
+
+def best_lags(template, signals, method='similarity', chunk_size=CHUNK_LAGS):
+    """
+    best position of the template in every signal
+    :param template: 1d array
+    :param signals: array of signals with shape = (..., samples)
+    :param method: 'correlation' - Pearson r (normalized_cross_correlation), 'match' - unmatched area (match),
+            'similarity' - unmatched area at the lag of the best correlation (similarity)
+    :param chunk_size: see sliding_match()
+    :return: two Numpy arrays with shape = (...) 1) lag of the best score 2) score, NaN if no lag has a score
+    """
+    if method == 'match':
+        scores = sliding_match(template, signals, chunk_size)
+    elif method in ('correlation', 'similarity'):
+        scores = sliding_correlation(template, signals)
+    else:
+        raise ValueError('Unknown method {}, use correlation, match or similarity'.format(method))
+    # NaN lags are ignored, lag 0 if no lag has a score as in normalized_cross_correlation()
+    lags = np.argmax(np.nan_to_num(scores, nan=-np.inf), axis=-1)
+    best = np.take_along_axis(scores, lags[..., np.newaxis], axis=-1)[..., 0]
+    if method == 'similarity':
+        template = np.asarray(template, dtype=float)
+        windows = sliding_window_view(np.asarray(signals, dtype=float), len(template), axis=-1)
+        window = np.take_along_axis(windows, lags[..., np.newaxis, np.newaxis], axis=-2)[..., 0, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            best = 1 - np.sum(abs(template - window), axis=-1) / (np.sum(abs(template))
+                                                                  + np.sum(abs(window), axis=-1))
+    return lags, best
+
+
+def _search_chunk(template, ecg_data, start, method, chunk_size):
+    # process pool worker of search: best lags of one chunk of points
+    lags, scores = best_lags(template, ecg_data, method, chunk_size)
+    return start, lags, scores
+
+
+def _top_k(results, start, lags, scores, channels, k):
+    # merges the k best (score, point, channel, lag) of a chunk into the results,
+    # ties are ordered by point and channel so the results do not depend on the order of the chunks
+    valid = np.flatnonzero(~np.isnan(scores.ravel()))
+    if len(valid) > k:
+        valid = valid[np.argpartition(scores.ravel()[valid], -k)[-k:]]
+    points, channel_rows = np.unravel_index(valid, scores.shape)
+    results += [(scores[p, c], -(start + p), -channels[c], lags[p, c]) for p, c in zip(points, channel_rows)]
+    return heapq.nlargest(k, results)
+
+
+def search(template, ecg_data, k=10, method='similarity', channels=None, chunk_points=CHUNK_POINTS, workers=1,
+           chunk_size=CHUNK_LAGS):
+    """
+    finds the points and channels of a study with the EGMs best matching the template
+    every (point, channel) is scored at its best lag, see best_lags()
+    :param template: 1d array
+    :param ecg_data: ecg data with the shape = (#of points, len(Mapping_channels), 2500) from
+            cartoutils.get_study_data_from_zip() or load_data(), memory-mapped arrays are read chunk by chunk
+    :param k: number of results
+    :param method: 'correlation', 'match' or 'similarity', see best_lags()
+    :param channels: indexes of the channels (axis 1 of ecg_data) to search, all channels by default
+    :param chunk_points: number of points per chunk, memory is bounded by a few chunks
+    :param workers: number of processes, chunks are searched in a process pool if workers != 1
+            (None = number of CPUs, at most the number of CPUs) and the study has at least POOL_MIN_POINTS points,
+            the pool pays off for large studies on several CPUs only
+    :param chunk_size: see sliding_match()
+    :return: list of up to k (point, channel, lag, score) sorted by descending score,
+             (point, channel) without score (e.g. flat EGM) are skipped
+    """
+    channels = list(range(ecg_data.shape[1])) if channels is None else list(channels)
+    chunks = ((start, ecg_data[start:start + chunk_points][:, channels])
+              for start in range(0, len(ecg_data), chunk_points))
+    results = []
+    workers = min(workers or os.cpu_count() or 1, os.cpu_count() or 1)  # more processes than CPUs only add overhead
+    if workers == 1 or len(ecg_data) < POOL_MIN_POINTS:
+        for start, chunk in chunks:
+            results = _top_k(results, *_search_chunk(template, chunk, start, method, chunk_size), channels, k)
+    else:
+        # at most 2 chunks per process are submitted, so the memory is bounded as in the serial search
+        max_pending = 2 * workers
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for start, chunk in chunks:
+                pending.add(executor.submit(_search_chunk, template, chunk, start, method, chunk_size))
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results = _top_k(results, *future.result(), channels, k)
+            for future in pending:
+                results = _top_k(results, *future.result(), channels, k)
+    return [(int(-point), -channel, int(lag), float(score))
+            for score, point, channel, lag in sorted(results, reverse=True)]
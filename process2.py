@@ -3,6 +3,8 @@ import re
 import numpy as np
 import os
 
+import ecg_writer
+
 
 def get_paths(epdata_dir):
     print("\n> Scanning {}...".format(epdata_dir))
@@ -74,40 +76,13 @@ def get_contact_data(filename, start=150, cols=[3, 4, 5]):
     return np.transpose(contact_data)
 
 
-def get_ecg_data(filename):
-    file = open(filename, 'r')
-    lines = file.readlines()
-    read_data = False
-    channels = np.empty((0, 6), int)
+# channels read by get_ecg_data
+ECG_CHANNELS = "M1", "M2", "M3", "M4", "M1-M2", "M3-M4"
 
-    for i, line in enumerate(lines):
 
-        d1 = "M1"
-        d2 = "M2"
-        d3 = "M3"
-        d4 = "M4"
-        d5 = "M1-M2"
-        d6 = "M3-M4"
-
-        if read_data:
-            newline = np.fromstring(line, dtype=int, sep=' ')
-            newline = [newline[d1_index], newline[d2_index], newline[d3_index], newline[d4_index], newline[d5_index], newline[d6_index]]
-            channels = np.append(channels, [newline], axis=0)
-
-        if i == 3:
-            read_data = True
-            channel_names = line.split()
-            for i, c in enumerate(channel_names):
-                result = re.search('(.*)\(.', c)
-                channel_names[i] = result.group(1)
-            d1_index = channel_names.index(d1)
-            d2_index = channel_names.index(d2)
-            d3_index = channel_names.index(d3)
-            d4_index = channel_names.index(d4)
-            d5_index = channel_names.index(d5)
-            d6_index = channel_names.index(d6)
-
-    return np.transpose(channels)
+def get_ecg_data(filename):
+    # the whole table is read at once and the channels are selected, see ecg_writer.read_leads
+    return ecg_writer.get_ecg_data(filename, ECG_CHANNELS)[0]
 
 
 def get_study_data(contact_files, ecg_files):
@@ -1,12 +1,22 @@
+import copy
+import itertools
+import os
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 # import pywt
 
+import binary_cache
+import matching
+
+INDEX_STEP = 10000  # samples between the byte offsets in the sample index
+ROLLING_CHUNK = 4000000  # values (pairs x samples) per chunk of rolling_correlation, 32 MB per float64 temporary
+PYRAMID_FACTOR = 4  # samples per bucket of a level of the decimation pyramid from the level below
+PLOT_POINTS = 4000  # points per line drawn by plot_channels, about twice the pixels of the plot width
 
-def get_channels(filename, channel_range=None, start=0, end=None):
-    # returns the matrix of all channels and axillary info
-    # within optional specified channel range and sample offset
+
+def read_header(file, filename, channel_range=None):
+    # reads the [Header] section of an opened file line by line
+    # and leaves the file positioned at the first sample line after [Data]
 
     # the header data will be returned as a python dictionary with following structure
     header = {
@@ -40,20 +50,11 @@ def get_channels(filename, channel_range=None, start=0, end=None):
         ]
     }
 
-    # convert to iterable tuple if range is a single number
-    if isinstance(channel_range, int):
-        channel_range = (channel_range,)
-
-    # Open a file
-    file = open(filename, 'r')
-    lines = file.readlines()
-
     # Read the header
-    separate_at, current_channel = 0, 0
-    for i, line in enumerate(lines):
+    current_channel = 0
+    for line in file:
         if line.strip() == "[Data]":
-            separate_at = i+1   # remember the index of the line where the ecg curve data starts
-            break
+            break   # the ecg curve data starts at the next line
         if line.strip() == "[Header]" or line.strip() == "":
             continue
         if line[:11] == "Data Format":
@@ -84,25 +85,173 @@ def get_channels(filename, channel_range=None, start=0, end=None):
                 header[var] = val
             elif current_channel > 0:
                 header["channel_info"][current_channel][var] = val
+    return header
+
+
+def read_samples(lines, columns):
+    # parses the sample lines in one vectorized call, only the specified columns are converted
+    # returns the matrix with shape = (len(columns), number of lines)
+    lines = iter(lines)
+    first_line = next(lines, None)
+    if first_line is None:  # no samples in the specified range
+        return np.empty((len(columns), 0), int)
+    samples = np.loadtxt(itertools.chain([first_line], lines), dtype=int, delimiter=',', usecols=columns, ndmin=2)
+    return np.transpose(samples)
 
-    if not end:  # use all samples if end is not specified
-        end = header["samples_per_channel"]
 
-    # additional data for returned header
-    header["channels"] = list(channel_range) if channel_range else list(range(1, header["channels_exported"]+1))
-    header["sample_count"] = len(lines[separate_at + start:separate_at+end])
+def build_sample_index(filename, step=INDEX_STEP):
+    # one pass over the file: byte offsets of every step-th sample line in the [Data] section
+    offsets = []
+    with open(filename, 'rb') as file:
+        for line in file:
+            if line.strip() == b"[Data]":
+                break
+        offset = file.tell()
+        for i, line in enumerate(iter(file.readline, b'')):
+            if i % step == 0:
+                offsets.append(offset)
+            offset += len(line)
+    return np.array(offsets, np.int64)
 
-    # Search for ecg data
-    channel_count = len(channel_range) if channel_range else header["channels_exported"]
-    channels = np.empty((0, channel_count), int)  # initialize channel matrix only for specified channel range
-    for i, line in enumerate(lines[separate_at+start:separate_at+end]):  # process only specified sample range
-        # stripping the line into np 1-D array, but only the according to specified channel range with np.take()
-        newline = np.take(np.fromstring(line, dtype=int, sep=','), channel_range if channel_range else range(header["channels_exported"]))
-        # adding data of the current sample to channel matrix
-        channels = np.append(channels, [newline], axis=0)
 
-    # transpose channel matrix and return
-    return np.transpose(channels), header
+def get_sample_index(filename, step=INDEX_STEP):
+    # returns the byte offsets of every step-th sample (see build_sample_index)
+    # the index is built once and cached next to the file as <filename>.idx.npz,
+    # it is rebuilt if the file was changed (size or modification time) or the step is different
+    stat = os.stat(filename)
+    index_filename = filename + '.idx.npz'
+    if os.path.exists(index_filename):
+        with np.load(index_filename) as cached:
+            if (cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns
+                    and cached["step"] == step):
+                return cached["offsets"]
+    offsets = build_sample_index(filename, step)
+    try:
+        np.savez(index_filename, offsets=offsets, step=step, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    except OSError:
+        pass  # read-only location, the index is used without caching
+    return offsets
+
+
+def _select_channel_info(header, channel_range):
+    # header of get_channels for a channel range from the header of all channels (see read_header)
+    header = copy.deepcopy(header)
+    if channel_range:
+        for info in header["channel_info"][1:]:
+            if info["channel_nr"] not in channel_range:
+                header["channel_info"][info["channel_nr"]] = dict(
+                    channel_nr=info["channel_nr"], label=None, range=None, low=None, high=None, sample_rate=None,
+                    color=None, scale=None)
+    return header
+
+
+def _get_cached_channels(filename):
+    # all samples of all channels from the binary cache (memory-mapped) and the header of all channels,
+    # the text file is parsed once on a cache miss
+    cached = binary_cache.get('ep', filename, mmap_mode='r')
+    if cached is not None:
+        return cached
+    with open(filename, 'r') as file:
+        header = read_header(file, filename)
+        samples = read_samples(file, list(range(header["channels_exported"])))
+    binary_cache.put('ep', filename, samples.T, header)
+    return samples.T, header
+
+
+def get_channels(filename, channel_range=None, start=0, end=None, use_index=False):
+    # returns the matrix of all channels and axillary info
+    # within optional specified channel range and sample offset
+    # with use_index=True the sample window is read with a single seek using the cached sample index
+    # (see get_sample_index), instead of skipping all lines before start
+    # if the binary cache is enabled (see binary_cache) a whole-file read parses the text file only on the first call,
+    # a window is taken from the cache if the file is already cached, otherwise it is read from the text file
+
+    # convert to iterable tuple if range is a single number
+    if isinstance(channel_range, int):
+        channel_range = (channel_range,)
+
+    if binary_cache.ENABLED:
+        if start == 0 and not end:
+            cached = _get_cached_channels(filename)
+        else:
+            cached = binary_cache.get('ep', filename, mmap_mode='r')
+        if cached is not None:
+            samples, header = cached
+            header = _select_channel_info(header, channel_range)
+            if not end:  # use all samples if end is not specified
+                end = header["samples_per_channel"]
+            header["channels"] = list(channel_range) if channel_range else list(range(1, header["channels_exported"]+1))
+            columns = list(channel_range) if channel_range else list(range(header["channels_exported"]))
+            channels = np.array(samples[start:end, columns].T, dtype=int)
+            header["sample_count"] = channels.shape[1]
+            return channels, header
+
+    # Open a file
+    with open(filename, 'r') as file:
+        # Read the header once, the file is left at the beginning of the data
+        header = read_header(file, filename, channel_range)
+
+        if not end:  # use all samples if end is not specified
+            end = header["samples_per_channel"]
+
+        # additional data for returned header
+        header["channels"] = list(channel_range) if channel_range else list(range(1, header["channels_exported"]+1))
+
+        # skip the lines before start without parsing them and read only the specified sample range,
+        # only the columns of the specified channel range are converted
+        columns = list(channel_range) if channel_range else list(range(header["channels_exported"]))
+        if use_index and start > 0:
+            offsets = get_sample_index(filename)
+            block = min(start // INDEX_STEP, len(offsets) - 1)
+            with open(filename, 'rb') as data_file:
+                data_file.seek(offsets[block])
+                first = block * INDEX_STEP
+                channels = read_samples(itertools.islice(data_file, start - first, end - first), columns)
+        else:
+            channels = read_samples(itertools.islice(file, start, end), columns)
+        header["sample_count"] = channels.shape[1]
+
+    return channels, header
+
+
+def make_pyramid(channels, factor=PYRAMID_FACTOR):
+    # min/max decimation pyramid of the matrix returned by get_channels for plotting long recordings,
+    # level k holds the minimum and the maximum of every bucket of factor ** k samples,
+    # the levels are computed on demand from the level below and kept in the pyramid (see get_level)
+    return {"channels": channels, "factor": factor, "levels": {0: (channels, channels)}}
+
+
+def get_level(pyramid, level):
+    # returns the (minimums, maximums) of the buckets of the level, both with shape = (channels, buckets)
+    levels = pyramid["levels"]
+    if level not in levels:
+        minimums, maximums = get_level(pyramid, level - 1)
+        starts = np.arange(0, minimums.shape[1], pyramid["factor"])  # the last bucket may be shorter
+        if len(starts) == 0:
+            levels[level] = minimums, maximums
+        else:
+            levels[level] = (np.minimum.reduceat(minimums, starts, axis=1),
+                             np.maximum.reduceat(maximums, starts, axis=1))
+    return levels[level]
+
+
+def decimate(pyramid, start=0, end=None, points=PLOT_POINTS):
+    # samples start:end of all channels with at most points per line (and more than points / 4) from the finest
+    # level with few enough buckets, every bucket gives its minimum and its maximum, so the envelope keeps all spikes
+    # returns the sample numbers with shape = (n,) and the values with shape = (channels, n)
+    samples = pyramid["channels"].shape[1]
+    end = samples if end is None else min(end, samples)
+    start = min(max(start, 0), end)
+    level = 0
+    while end - start > points and 2 * -(-(end - start) // pyramid["factor"] ** level) > points:
+        level += 1
+    if level == 0:
+        return np.arange(start, end), pyramid["channels"][:, start:end]
+    size = pyramid["factor"] ** level
+    minimums, maximums = get_level(pyramid, level)
+    buckets = slice(start // size, -(-end // size))
+    values = np.stack([minimums[:, buckets], maximums[:, buckets]], axis=-1).reshape(len(minimums), -1)
+    return np.repeat(np.arange(buckets.start, buckets.stop) * size, 2), values
 
 
 def plot_channels(channels, header):
@@ -118,13 +267,17 @@ def plot_channels(channels, header):
     # Visualization of all channels
     fig = plt.figure()
 
+    # the lines are drawn from the decimation pyramid with about PLOT_POINTS points,
+    # zooming redraws them from the level of the visible samples
+    pyramid = make_pyramid(channels)
+    x, values = decimate(pyramid)
     if len(channels) > 1:
         fig.suptitle("{} samples of {} channels in {}".format(samples_count, channels_count, header["file_name"]))
         gs = fig.add_gridspec(len(channels), hspace=0.7)
         axs = gs.subplots(sharex=True)
-        for i, channel in enumerate(channels):
+        for i, channel in enumerate(values):
             # axs[i].plot (pywt.wavedec(channel, 'db4', level=7)[0])   # looks fine without Filter
-            axs[i].plot(channel)
+            axs[i].plot(x, channel)
             axs[i].set_title(ci[channels_returned[i]]["label"], loc='left', y=0.7)
             # axs[i].get_xaxis ().set_visible (True)
             # axs[i].set_xticks ([])
@@ -133,10 +286,20 @@ def plot_channels(channels, header):
         # plt.grid(True)
     else:  # if only a single channel was passed
         fig.suptitle("{} samples of channel {} in {}".format(samples_count, ci[channels_returned[0]]["label"], header["file_name"]))
-        axs = fig.add_subplot(1, 1, 1)
-        axs.plot(channels[0])
-        axs.set_title(ci[channels_returned[0]]["label"], loc='left', y=0.7)
-        axs.axis('off')
+        axs = [fig.add_subplot(1, 1, 1)]
+        axs[0].plot(x, values[0])
+        axs[0].set_title(ci[channels_returned[0]]["label"], loc='left', y=0.7)
+        axs[0].axis('off')
+
+    def redraw(ax):
+        # the limits of the shared x axis are set on the zoomed axes only, so every axes is connected
+        low, high = ax.get_xlim()
+        x, values = decimate(pyramid, int(np.floor(low)), int(np.ceil(high)) + 1)
+        for lead_ax, channel in zip(axs, values):
+            lead_ax.lines[0].set_data(x, channel)
+
+    for ax in axs:
+        ax.callbacks.connect('xlim_changed', redraw)
     plt.show()
 
 
@@ -170,14 +333,43 @@ def main():
     plot_channels(channels, header)
 
 
+def rolling_correlation(channels, window=3, pairs=None, chunk_size=ROLLING_CHUNK):
+    # rolling Pearson correlation of pairs of channels (rows of the matrix returned by get_channels),
+    # the sums of every window are differences of cumulative sums, so the cost does not depend on the window size
+    # the recording is processed in chunks of chunk_size values, i.e. chunk_size / len(pairs) samples
+    # (overlapping by window - 1 samples), so the memory does not grow with the number of pairs
+    # returns the matrix with shape = (len(pairs), number of samples) and the list of pairs,
+    # the first window - 1 samples and windows without variance are NaN as in pandas rolling().corr()
+    channels = np.asarray(channels, dtype=float)
+    if pairs is None:  # all pairs of channels
+        pairs = list(itertools.combinations(range(len(channels)), 2))
+    first, second = np.array(pairs, dtype=int).reshape(-1, 2).T
+    samples = channels.shape[1]
+    correlation = np.full((len(first), samples), np.nan)
+    chunk_samples = max(chunk_size // max(len(first), len(channels), 1), window)
+
+    for start in range(0, max(samples - window + 1, 0), chunk_samples):
+        # the chunk is centered to keep the cumulative sums small
+        chunk = channels[:, start:start + chunk_samples + window - 1]
+        chunk = chunk - chunk.mean(axis=1, keepdims=True)
+        sum_1, sum_2 = matching.window_sums(chunk, window), matching.window_sums(chunk * chunk, window)
+        # window * variance of every channel, NaN if the window has no variance (rounding leaves a tiny one)
+        variance = window * sum_2 - sum_1 * sum_1
+        variance[variance <= 1e-10 * window * sum_2] = np.nan
+        deviation = np.sqrt(variance)
+        r = window * matching.window_sums(chunk[first] * chunk[second], window) - sum_1[first] * sum_1[second]
+        r /= deviation[first]
+        r /= deviation[second]
+        correlation[:, start + window - 1:start + window - 1 + r.shape[1]] = np.clip(r, -1., 1., out=r)
+    return correlation, pairs
+
+
 def correlate():
     # Rolling window correlation
-    d1 = get_channels('ecg.txt', 1, start=50000, end=50900)[0]
-    d2 = get_channels('ecg.txt', 2, start=50000, end=50900)[0]
-    df = pd.DataFrame({'d1': d1[0],
-                       'd2': d2[0]})
-    cor = df['d1'].rolling(3).corr(df['d2'])
-    plot_graph([d1, d2, [cor.tolist()]])
+    channels = get_channels('ecg.txt', (1, 2), start=50000, end=50900, use_index=True)[0]
+    d1, d2 = channels[0:1], channels[1:2]
+    cor, _ = rolling_correlation(channels, 3)
+    plot_graph([d1, d2, cor])
 
 
 if __name__ == '__main__':